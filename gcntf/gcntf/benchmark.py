@@ -0,0 +1,385 @@
+import os, sys, time
+import io, glob
+import importlib
+import asyncio
+import tempfile
+import argparse
+import torch
+import numpy as np
+from data import Dataloader
+from gcntf import gcntf
+from utils import ADE_FDE, FPC, batch_FPC
+
+parser = argparse.ArgumentParser()
+parser.add_argument("bench", nargs="+")
+parser.add_argument("--agents", type=int, default=60)
+parser.add_argument("--frames", type=int, default=300)
+parser.add_argument("--ob-horizon", type=int, default=8)
+parser.add_argument("--pred-horizon", type=int, default=12)
+parser.add_argument("--batch-size", type=int, default=128)
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--ckpt", type=str, default=None)
+parser.add_argument("--test", nargs="+", default=[], help="test files for the accuracy of trained models")
+
+
+def synthetic_scene(filename, n_agents, n_frames, rng):
+    # random walkers in an ETH/UCY style text file: frame, agent id, x, y
+    rows = []
+    for aid in range(n_agents):
+        start = rng.randint(0, max(1, n_frames - 30))
+        length = rng.randint(20, 80)
+        p = rng.uniform(0, 15, 2)
+        v = rng.uniform(-0.4, 0.4, 2)
+        for t in range(start, min(n_frames, start + length)):
+            v = v + rng.randn(2) * 0.05
+            p = p + v
+            rows.append((t * 10, aid, p[0], p[1]))
+    rows.sort()
+    with open(filename, "w") as f:
+        for t, aid, x, y in rows:
+            f.write("{:.1f}\t{:.1f}\t{:.2f}\t{:.2f}\n".format(t, aid, x, y))
+
+
+def synthetic_dataset(settings, **kwargs):
+    rng = np.random.RandomState(settings.seed)
+    root = tempfile.mkdtemp()
+    filename = os.path.join(root, "synthetic.txt")
+    synthetic_scene(filename, settings.agents, settings.frames, rng)
+    kwargs = dict(dict(
+        ob_horizon=settings.ob_horizon, pred_horizon=settings.pred_horizon,
+        batch_size=settings.batch_size, device=torch.device("cpu"), seed=settings.seed
+    ), **kwargs)
+    return Dataloader([filename], **kwargs)
+
+
+def timeit(fn, repeat):
+    fn()
+    tic = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - tic) / repeat
+
+
+def bench_bucket(settings):
+    torch.manual_seed(settings.seed)
+    dataset = synthetic_dataset(settings, shuffle=True)
+    model = gcntf(horizon=settings.pred_horizon).eval()
+    n_neighbors = dataset.n_neighbors()
+    samplers = dict(
+        random=dataset.batch_sampler,
+        bucket=Dataloader.BucketBatchSampler(n_neighbors, dataset.batch_sampler.sampler,
+                                             settings.batch_size, True)
+    )
+
+    for name, sampler in samplers.items():
+        batches = list(sampler)
+        if not batches:
+            print(" Not enough samples for a batch of {}.".format(settings.batch_size))
+            return
+        padding = 1 - sum(n_neighbors[b].sum() for b in batches) / sum(len(b) * n_neighbors[b].max() for b in batches)
+        collated = [dataset.collate_fn([dataset[i] for i in b]) for b in batches]
+
+        def step():
+            with torch.no_grad():
+                for x, y, neighbor in collated:
+                    model.enc(x, neighbor[:x.size(0)])
+
+        print(" {:>6} batches: {} of {}, padding {:.1%}, encoder {:.2f}ms per epoch".format(
+            name, len(batches), settings.batch_size, padding, timeit(step, settings.repeat) * 1000
+        ))
+
+
+def bench_encoder(settings):
+    torch.manual_seed(settings.seed)
+    dataset = synthetic_dataset(settings)
+    model = gcntf(horizon=settings.pred_horizon).eval()
+    batches = [dataset.collate_fn([dataset[i] for i in idx]) for idx in dataset.batch_sampler]
+    if not batches:
+        print(" Not enough samples for a batch of {}.".format(settings.batch_size))
+        return
+
+    def encode():
+        with torch.no_grad():
+            return [model.enc(x, neighbor[:x.size(0)])
+                    for x, y, neighbor in batches]
+
+    results = {}
+    for mode in ("loop", "packed"):
+        model.enc_mode = mode
+        results[mode] = encode()
+        t_enc = timeit(encode, settings.repeat)
+        if mode == "loop": t_enc_loop = t_enc
+        err = max((a - b).abs().max().item() for a, b in zip(results[mode], results["loop"]))
+        print(" encoder {:>6}, batch of {}: {:.2f}ms ({:.2f}x); max abs diff {:.1e}".format(
+            mode, settings.batch_size, t_enc / len(batches) * 1000, t_enc_loop / t_enc, err
+        ))
+
+
+def random_scene(n_agents, n_neighbors, horizon, rng, padding=0.3, area=40.):
+    # agents and neighbors walking in random directions; a fraction of neighbor slots is padding
+    def walk(*shape):
+        p = torch.rand(*shape, 2, generator=rng) * area
+        v = torch.randn(*shape, 2, generator=rng) * 0.5
+        t = torch.arange(horizon, dtype=torch.float32).view(-1, *[1] * (len(shape) + 1))
+        pos = p + t * v
+        vel = v.expand_as(pos)
+        return torch.cat((pos, vel, torch.zeros_like(pos)), -1)
+    x = walk(n_agents)  # L x N x 6
+    neighbor = walk(n_agents, n_neighbors)  # L x N x Nn x 6
+    pad = torch.rand(n_agents, n_neighbors, generator=rng) < padding
+    neighbor[:, pad] = 1e9
+    return x, neighbor
+
+
+def bench_attention(settings):
+    torch.manual_seed(settings.seed)
+    rng = torch.Generator().manual_seed(settings.seed)
+    model = gcntf(horizon=settings.pred_horizon, ob_radius=5).eval()
+
+    def attention_index(q, k, mask):
+        # the previous implementation, with boolean index assignment and a NaN pass
+        e = model.attention_nonlinearity((k @ q.unsqueeze(-1)).squeeze(-1))
+        e[~mask] = -float("inf")
+        return torch.nn.functional.softmax(e, dim=-1).nan_to_num()
+
+    for n_neighbors in (8, 64, 512):
+        x, neighbor = random_scene(settings.batch_size, n_neighbors, settings.ob_horizon, rng)
+        q = torch.randn(settings.batch_size, 256, generator=rng)
+        k = torch.randn(settings.batch_size, n_neighbors, 256, generator=rng)
+        mask = (neighbor[1, ..., :2] - x[1, :, None, :2]).norm(dim=-1) <= model.ob_radius
+        index = mask.nonzero()[:, 0]
+        k_packed = k[mask]
+        with torch.no_grad():
+            ref = attention_index(q, k, mask)
+            err = (model.attention(q, k, mask) - ref).abs().max().item()
+            err_packed = (model.attention_packed(q, k_packed, index) - ref[mask]).abs().max().item()
+            t_index = timeit(lambda: attention_index(q, k, mask), settings.repeat * 20)
+            t_fill = timeit(lambda: model.attention(q, k, mask), settings.repeat * 20)
+            t_packed = timeit(lambda: model.attention_packed(q, k_packed, index), settings.repeat * 20)
+
+        encoded = {}
+
+        def encode():
+            with torch.no_grad():
+                return model.enc(x, neighbor)
+
+        t_enc = {}
+        for mode in ("loop", "packed"):
+            model.enc_mode = mode
+            encoded[mode] = encode()
+            t_enc[mode] = timeit(encode, settings.repeat)
+        print(" Nn {:>3} ({:.1%} in range), batch of {}: attention index {:.3f}ms, masked_fill {:.3f}ms, "
+              "packed {:.3f}ms, max abs diff {:.1e}/{:.1e}; encoder loop {:.2f}ms, packed {:.2f}ms ({:.2f}x), "
+              "max abs diff {:.1e}".format(
+            n_neighbors, mask.float().mean().item(), settings.batch_size,
+            t_index * 1000, t_fill * 1000, t_packed * 1000, err, err_packed,
+            t_enc["loop"] * 1000, t_enc["packed"] * 1000, t_enc["loop"] / t_enc["packed"],
+            (encoded["loop"] - encoded["packed"]).abs().max().item()
+        ))
+
+
+def bench_fpc(settings):
+    # multimodal endpoint predictions around a ground-truth goal per agent
+    rng = torch.Generator().manual_seed(settings.seed)
+    torch.manual_seed(settings.seed)
+    np.random.seed(settings.seed)
+    N, K = settings.batch_size, 20
+    for fpc in (2, 10, 40, 49):
+        S = K * fpc
+        goal = torch.randn(N, 1, 2, generator=rng) * 3
+        modes = goal + torch.randn(N, 4, 2, generator=rng) * 2
+        pick = torch.randint(4, (N, S), generator=rng)
+        end = modes[torch.arange(N).unsqueeze(-1), pick] + torch.randn(N, S, 2, generator=rng) * 0.5
+        y = torch.cat((torch.zeros_like(end).unsqueeze(2), end.unsqueeze(2)), 2)  # N x S x 2 x 2
+
+        def old():
+            return np.stack([FPC(y[i].numpy(), n_samples=K) for i in range(N)])
+
+        def new():
+            return batch_FPC(y, n_samples=K).numpy()
+
+        def min_fde(chosen):
+            return (end[torch.arange(N).unsqueeze(-1), torch.as_tensor(chosen)] - goal).norm(dim=-1).min(-1)[0].mean()
+
+        t_old, t_new = timeit(old, settings.repeat), timeit(new, settings.repeat)
+        print(" FPC {:>2} ({} samples per agent, {} agents): per-agent {:.1f}ms, batched {:.1f}ms ({:.1f}x); "
+              "minFDE of the selection {:.4f} vs {:.4f}, all samples {:.4f}".format(
+            fpc, S, N, t_old * 1000, t_new * 1000, t_old / t_new,
+            min_fde(old()), min_fde(new()), min_fde(np.tile(np.arange(S), (N, 1)))
+        ))
+
+
+def min_ade_fde(pred, batches):
+    # best-of-K errors over the batches; pred: list of K x L2 x N x 2
+    ade, fde = zip(*(ADE_FDE(y_, y) for y_, (x, y, _) in zip(pred, batches)))
+    return torch.cat([a.min(0)[0] for a in ade]).mean().item(), torch.cat([f.min(0)[0] for f in fde]).mean().item()
+
+
+def eval_batches(settings):
+    # the test files when given, otherwise a synthetic scene
+    if settings.test:
+        dataset = Dataloader(settings.test, ob_horizon=settings.ob_horizon, pred_horizon=settings.pred_horizon,
+                             batch_size=settings.batch_size, device=torch.device("cpu"), seed=settings.seed)
+    else:
+        dataset = synthetic_dataset(settings)
+    return [dataset.collate_fn([dataset[i] for i in idx]) for idx in dataset.batch_sampler]
+
+
+def config_models(settings):
+    # a model for every config in config/, with weights from <ckpt>/<config>/ckpt-best when present;
+    # yields the name, the config, the model and whether the weights were loaded
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
+    for filename in sorted(glob.glob(os.path.join(root, "*.py"))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        spec = importlib.util.spec_from_file_location("config", filename)
+        config = importlib.util.module_from_spec(spec)
+        try:
+            spec.loader.exec_module(config)
+        except (ValueError, OSError) as e:
+            # configs that read dataset files on import, e.g. for per-scene scales
+            print(" {}: skipped, the config cannot be loaded without its dataset ({})".format(name, e))
+            continue
+        torch.manual_seed(settings.seed)
+        model = gcntf(horizon=settings.pred_horizon, ob_radius=config.OB_RADIUS, hidden_dim=config.RNN_HIDDEN_DIM)
+        ckpt = os.path.join(settings.ckpt, name, "ckpt-best") if settings.ckpt else None
+        trained = bool(ckpt) and os.path.exists(ckpt)
+        if trained:
+            model.load_state_dict(torch.load(ckpt, map_location="cpu", weights_only=False)["model"])
+        yield name, config, model.eval(), trained
+
+
+def accuracy(trained, ade, fde, ade_ref, fde_ref):
+    # ADE/FDE only mean something for trained weights
+    if not trained:
+        return "untrained, no accuracy"
+    return "ADE {:.4f} -> {:.4f} ({:+.4f}), FDE {:.4f} -> {:.4f} ({:+.4f})".format(
+        ade_ref, ade, ade - ade_ref, fde_ref, fde, fde - fde_ref
+    )
+
+
+def bench_amp(settings):
+    # fp32 vs autocast for every config, on the same batches with the same noise;
+    # the ADE/FDE deltas are reported only for trained weights, read from <ckpt>/<config>/ckpt-best
+    batches = eval_batches(settings)
+    if not batches:
+        print(" Not enough samples for a batch of {}.".format(settings.batch_size))
+        return
+    K = 20
+
+    def predict(model, dtype):
+        torch.manual_seed(settings.seed)
+        with torch.no_grad(), torch.autocast("cpu", dtype=dtype, enabled=dtype is not None):
+            return [model.sample(model.encode(x, neighbor[:x.size(0)]), K) + x[-1, ..., :2]
+                    for x, y, neighbor in batches]
+
+    dtypes = dict(fp32=None, bf16=torch.bfloat16)
+    for name, config, model, trained in config_models(settings):
+        ref = predict(model, None)
+        ade_ref, fde_ref = min_ade_fde(ref, batches)
+        for key, dtype in dtypes.items():
+            pred = ref if dtype is None else predict(model, dtype)
+            ade, fde = min_ade_fde(pred, batches)
+            err = max((a - b).abs().max().item() for a, b in zip(pred, ref))
+            t = timeit(lambda: predict(model, dtype), settings.repeat)
+            print(" {}, hidden {}, radius {}, {}: {}, max abs diff to fp32 {:.1e}; "
+                  "{:.2f}ms per batch of {} with {} samples".format(
+                name, config.RNN_HIDDEN_DIM, config.OB_RADIUS, key, accuracy(trained, ade, fde, ade_ref, fde_ref),
+                err, t / len(batches) * 1000, settings.batch_size, K
+            ))
+
+
+def bench_quantize(settings):
+    # fp32 vs dynamic int8 for every config, on the same batches with the same noise;
+    # the ADE/FDE deltas are reported only for trained weights, read from <ckpt>/<config>/ckpt-best
+    batches = eval_batches(settings)
+    if not batches:
+        print(" Not enough samples for a batch of {}.".format(settings.batch_size))
+        return
+    K = 20
+
+    def predict(model):
+        torch.manual_seed(settings.seed)
+        with torch.no_grad():
+            return [model.predict(x, neighbor[:x.size(0)], K) for x, y, neighbor in batches]
+
+    def size(model):
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        return buffer.tell() / 2**20
+
+    for name, config, model, trained in config_models(settings):
+        quantized = model.quantize()
+        result = {}
+        for key, m in (("fp32", model), ("int8", quantized)):
+            pred = predict(m)
+            result[key] = pred, timeit(lambda: predict(m), settings.repeat) / len(batches), size(m)
+        (pred, t, mb), (pred_q, t_q, mb_q) = result["fp32"], result["int8"]
+        err = max((a - b).abs().max().item() for a, b in zip(pred_q, pred))
+        print(" {}, hidden {}: {}, max abs diff to fp32 {:.1e}; "
+              "{:.2f}ms -> {:.2f}ms per batch of {} ({:.2f}x); {:.1f}MB -> {:.1f}MB".format(
+            name, config.RNN_HIDDEN_DIM,
+            accuracy(trained, *min_ade_fde(pred_q, batches), *min_ade_fde(pred, batches)), err,
+            t * 1000, t_q * 1000, settings.batch_size, t / t_q, mb, mb_q
+        ))
+
+
+def bench_server(settings):
+    # concurrent clients with a few agents each, against the batching server over local HTTP;
+    # a window of 0 runs every request on its own
+    from server import BatchingServer, Client
+    torch.manual_seed(settings.seed)
+    rng = torch.Generator().manual_seed(settings.seed)
+    model = gcntf(horizon=settings.pred_horizon, ob_radius=5, enc_mode="packed").eval()
+    requests = [random_scene(4, 8, settings.ob_horizon, rng) for _ in range(16)]
+
+    async def run(max_delay, concurrency, n_requests):
+        server = BatchingServer(model, settings.ob_horizon, n_samples=20, max_delay=max_delay)
+        listener = await server.start("127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        clients = [Client("127.0.0.1", port) for _ in range(concurrency)]
+
+        async def load(i, client):
+            for r in range(i, n_requests, concurrency):
+                await client.predict(*requests[r % len(requests)])
+
+        await asyncio.gather(*(load(i, c) for i, c in enumerate(clients)))  # warm up
+        server.reset_metrics()
+        tic = time.perf_counter()
+        await asyncio.gather(*(load(i, c) for i, c in enumerate(clients)))
+        elapsed = time.perf_counter() - tic
+        metrics = await clients[0].request("GET", "/metrics")
+        for c in clients: await c.close()
+        listener.close()
+        server.executor.shutdown()
+        return elapsed, metrics
+
+    for concurrency in (1, 4, 16, 64):
+        for max_delay in (0, 0.005):
+            n_requests = max(32, concurrency * 4)
+            elapsed, metrics = asyncio.run(run(max_delay, concurrency, n_requests))
+            print(" {:>2} clients, window {:.0f}ms: {:.1f} requests/s; {:.1f} requests per batch; "
+                  "latency p50 {:.1f}ms, p99 {:.1f}ms".format(
+                concurrency, max_delay * 1000, n_requests / elapsed, metrics["requests"] / metrics["batches"],
+                metrics["latency_p50"], metrics["latency_p99"]
+            ))
+
+
+BENCHMARKS = dict(
+    bucket=bench_bucket,
+    encoder=bench_encoder,
+    attention=bench_attention,
+    fpc=bench_fpc,
+    amp=bench_amp,
+    quantize=bench_quantize,
+    server=bench_server,
+)
+
+if __name__ == "__main__":
+    settings = parser.parse_args()
+    for name in settings.bench:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark: {}. Options: {}".format(name, ", ".join(BENCHMARKS)))
+            sys.exit(1)
+    for name in settings.bench:
+        BENCHMARKS[name](settings)
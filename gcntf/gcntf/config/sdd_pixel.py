@@ -10,7 +10,6 @@ EPOCH_BATCHES = 100
 TEST_SINCE = 400
 PRED_SAMPLES = 20
 FPC_SEARCH_RANGE = range(40, 50)
-WORLD_SCALE = []
 import os, sys
 data_dir = sys.argv[sys.argv.index("--test")+1]
 data_dir = os.path.dirname(data_dir)
@@ -26,26 +25,5 @@ with open(H_file, "r") as f:
         scale = float(item[-1])
         H[scene] = 1./scale
 
-for scene, n_trajs in [
-    ("coupa_0", 323), 
-    ("coupa_1", 235), 
-    ("gates_2", 155), 
-    ("hyang_0", 630), 
-    ("hyang_1", 427), 
-    ("hyang_3", 61), 
-    ("hyang_8", 12), 
-    ("little_0", 52), 
-    ("little_1", 110), 
-    ("little_2", 42), 
-    ("little_3", 362), 
-    ("nexus_5", 14), 
-    ("nexus_6", 334), 
-    ("quad_0", 10), 
-    ("quad_1", 20), 
-    ("quad_2", 30), 
-    ("quad_3", 12)
-]:
-    scale = H[scene]
-    WORLD_SCALE.extend([scale] * n_trajs)
-
-
+# test scenes are tagged by file name, e.g. coupa_0.txt
+WORLD_SCALE = H
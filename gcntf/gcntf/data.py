@@ -1,6 +1,8 @@
 from typing import Optional, Sequence, List
 
-import os, sys
+import os, sys, io
+import shutil
+import hashlib
 import torch
 import numpy as np
 
@@ -35,13 +37,102 @@ class Dataloader(torch.utils.data.Dataset):
                     yield batch
                     batch = []
 
+    class DistributedSampler(torch.utils.data.sampler.Sampler):
+        # The shard of one process: every num_replicas-th index, starting from rank, of a
+        # permutation shared by all processes, so that shards do not overlap and nothing is
+        # repeated to even them out. The permutation is drawn again on every pass, since the
+        # batch samplers restart the sampler whenever it runs out, also within an epoch.
+        # When shuffling, shards are trimmed to len(data_source) // num_replicas, so that all
+        # processes run out, and move on to the next permutation, at the same step.
+        def __init__(self, data_source, num_replicas, rank, shuffle=False, seed=0):
+            self.data_source = data_source
+            self.num_replicas = num_replicas
+            self.rank = rank
+            self.shuffle = shuffle
+            self.seed = seed
+            self.epoch = 0
+
+        def __len__(self):
+            if self.shuffle:
+                return len(self.data_source) // self.num_replicas
+            return len(range(self.rank, len(self.data_source), self.num_replicas))
+
+        def __iter__(self):
+            if self.shuffle:
+                g = torch.Generator().manual_seed(self.seed + self.epoch)
+                indices = torch.randperm(len(self.data_source), generator=g).tolist()
+            else:
+                indices = list(range(len(self.data_source)))
+            self.epoch += 1
+            return iter(indices[self.rank::self.num_replicas][:len(self)])
+
+    class BucketBatchSampler(torch.utils.data.sampler.BatchSampler):
+        # Draws pools of pool_batches * batch_size samples in random order, sorts each pool
+        # by neighbor count and cuts it into batches, so that samples in a batch need similar
+        # padding. Batches of a pool are yielded in random order. The remainder of a pool
+        # that does not fill a batch is taken before sorting, so that drop_last drops a
+        # random subset and not the most crowded samples.
+        def __init__(self, n_neighbors, sampler, batch_size, drop_last, n_batches=None, pool_batches=32):
+            super().__init__(sampler, batch_size, drop_last)
+            self.n_neighbors = np.asarray(n_neighbors)
+            self.n_batches = n_batches
+            self.pool_size = pool_batches * batch_size
+            self.shuffle = getattr(sampler, "shuffle",
+                                   not isinstance(sampler, torch.utils.data.sampler.SequentialSampler))
+            self.sampler_iter = None
+            self.slots, self.padded = 0, 0
+
+        def __len__(self):
+            if self.n_batches is not None: return self.n_batches
+            return super().__len__()
+
+        def pools(self):
+            if not len(self.sampler): return
+            while True:
+                if self.sampler_iter is None:
+                    self.sampler_iter = iter(self.sampler)
+                pool = [idx for _, idx in zip(range(self.pool_size), self.sampler_iter)]
+                if len(pool) < self.pool_size:
+                    self.sampler_iter = None
+                if pool: yield pool
+                if self.sampler_iter is None and self.n_batches is None: break
+
+        def __iter__(self):
+            counter = 0
+            for pool in self.pools():
+                pool = np.asarray(pool)
+                n = len(pool) // self.batch_size * self.batch_size
+                pool, rest = pool[:n], pool[n:]
+                pool = pool[np.argsort(self.n_neighbors[pool], kind="stable")]
+                batches = pool.reshape(-1, self.batch_size).tolist()
+                if self.shuffle:
+                    batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+                if len(rest) and not self.drop_last:
+                    batches.append(rest.tolist())
+                for batch in batches:
+                    if self.n_batches is not None and counter >= self.n_batches: return
+                    counter += 1
+                    n = self.n_neighbors[batch]
+                    self.slots += len(batch) * n.max()
+                    self.padded += len(batch) * n.max() - n.sum()
+                    yield batch
+
+        def padding_ratio(self, reset=True):
+            # fraction of neighbor slots filled with padding in the batches yielded so far
+            ratio = self.padded / self.slots if self.slots else 0
+            if reset: self.slots, self.padded = 0, 0
+            return ratio
+
     def __init__(self,
                  files: List[str], ob_horizon: int, pred_horizon: int,
                  batch_size: int, drop_last: bool = True, shuffle: bool = False, batches_per_epoch=None,
                  frameskip: int = 1, inclusive_groups: Optional[Sequence] = None,
                  batch_first: bool = False, seed: Optional[int] = None,
                  device: Optional[torch.device] = None,
-                 flip: bool = False, rotate: bool = False, scale: bool = False
+                 flip: bool = False, rotate: bool = False, scale: bool = False,
+                 cache_dir: Optional[str] = None, neighbor_radius: Optional[float] = None,
+                 bucket: bool = False, cpu_collate: bool = False,
+                 num_replicas: int = 1, rank: int = 0
                  ):
         super().__init__()
         self.ob_horizon = ob_horizon
@@ -52,6 +143,10 @@ class Dataloader(torch.utils.data.Dataset):
         self.flip = flip
         self.rotate = rotate
         self.scale = scale
+        self.neighbor_radius = neighbor_radius
+        # collate into CPU tensors, e.g. in DataLoader worker processes, and
+        # move batches to the device with to_device in the training loop
+        self.cpu_collate = cpu_collate
         if device is None:
             self.device = torch.device("cuda:0" if torch.cuda.is_available else "cpu")
         else:
@@ -71,35 +166,82 @@ class Dataloader(torch.utils.data.Dataset):
             elif os.path.exists(path):
                 files_.append((path, incl_g))
         data_files = sorted(files_, key=lambda _: _[0])
-        data = []
-        done = 0
-        max_workers = min(len(data_files), torch.get_num_threads(), 20)
-        with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"), max_workers=max_workers) as p:
-            futures = [p.submit(self.__class__.load, self, f, incl_g) for f, incl_g in data_files]
-            for fut in as_completed(futures):
-                done += 1
-                sys.stdout.write("\r\033[K Loading data files...{}/{}".format(
-                    done, len(data_files)
-                ))
-            for fut in futures:
-                item = fut.result()
-                if item is not None:
-                    data.extend(item)
-                sys.stdout.write("\r\033[K Loading data files...{}/{} ".format(
-                    done, len(data_files)
-                ))
-        self.data = np.array(data, dtype=object)
+        data = [None] * len(data_files)
+        pending = []
+        cache = [None] * len(data_files)
+        for i, (f, incl_g) in enumerate(data_files):
+            if cache_dir is not None:
+                cache[i] = os.path.join(cache_dir, self.cache_key(f, incl_g))
+                if os.path.isdir(cache[i]):
+                    data[i] = self.load_cache(cache[i])
+                    continue
+            pending.append(i)
+        done = len(data_files) - len(pending)
+        if pending:
+            max_workers = min(len(pending), torch.get_num_threads(), 20)
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"), max_workers=max_workers) as p:
+                futures = [p.submit(self.__class__.load, self, *data_files[i]) for i in pending]
+                for fut in as_completed(futures):
+                    done += 1
+                    sys.stdout.write("\r\033[K Loading data files...{}/{}".format(
+                        done, len(data_files)
+                    ))
+                for i, fut in zip(pending, futures):
+                    data[i] = fut.result()
+                    if data[i] is None:
+                        data[i] = self.empty_columns()
+                    if cache[i] is not None:
+                        self.save_cache(cache[i], data[i])
+        sys.stdout.write("\r\033[K Loading data files...{}/{} ".format(
+            done, len(data_files)
+        ))
+        if len(pending) < len(data_files):
+            sys.stdout.write("({} from cache)".format(len(data_files) - len(pending)))
+        # Each window's scene (N x L x 6, agents first, then partially observed
+        # neighbors) is stored once in a flat buffer. A sample is an agent index
+        # into its window; its neighbors are the other agents of that window.
+        columns = data[0] if len(data) == 1 else self.merge_columns(data)
+        # source of every sample, as an index into files; file names serve as scene names
+        self.files = [f for f, _ in data_files]
+        self.scene_names = [os.path.splitext(os.path.basename(f))[0] for f in self.files]
+        self.sample_file = np.repeat(np.arange(len(data)), [len(d["window"]) for d in data])  # S
         del data
-        print("\n   {} trajectories loaded.".format(len(self.data)))
+        self.scene = columns["scene"]  # sum(N) x L x 6
+        self.scene_offsets = columns["scene_offsets"]  # W + 1
+        self.sample_window = columns["window"]  # S
+        self.sample_agent = columns["agent"]  # S
+        if self.neighbor_radius is None:
+            self.neighbor_offsets, self.neighbor_index = None, None
+        else:
+            # neighbors of sample i are the window columns neighbor_index[neighbor_offsets[i]:neighbor_offsets[i+1]]
+            self.neighbor_offsets = columns["neighbor_offsets"]  # S + 1
+            self.neighbor_index = columns["neighbor"]  # sum(Nn)
+        print("\n   {} trajectories loaded.".format(len(self)))
+        if self.neighbor_radius is not None and len(self):
+            n_all = np.diff(self.scene_offsets)[self.sample_window] - 1
+            n_kept = np.diff(self.neighbor_offsets)
+            print("   Neighbors within {}: {:.1f} per sample on average, {:.1f} before pruning ({:.1%} removed); "
+                  "max {} -> {}.".format(
+                self.neighbor_radius, n_kept.mean(), n_all.mean(), 1 - n_kept.sum() / max(1, n_all.sum()),
+                n_all.max(), n_kept.max()
+            ))
 
         self.rng = np.random.RandomState()
-        if seed: self.rng.seed(seed)
+        # augmentation differs across processes; the shard permutation below is shared
+        if seed: self.rng.seed(seed + rank)
 
-        if shuffle:
+        if num_replicas > 1:
+            # batch_size is per process
+            sampler = self.__class__.DistributedSampler(self, num_replicas, rank, shuffle, seed or 0)
+        elif shuffle:
             sampler = torch.utils.data.sampler.RandomSampler(self)
         else:
             sampler = torch.utils.data.sampler.SequentialSampler(self)
-        if batches_per_epoch is None:
+        if bucket:
+            self.batch_sampler = self.__class__.BucketBatchSampler(self.n_neighbors(), sampler, batch_size,
+                                                                   drop_last, batches_per_epoch)
+            self.batches_per_epoch = len(self.batch_sampler)
+        elif batches_per_epoch is None:
             self.batch_sampler = torch.utils.data.sampler.BatchSampler(sampler, batch_size, drop_last)
             self.batches_per_epoch = len(self.batch_sampler)
         else:
@@ -107,92 +249,171 @@ class Dataloader(torch.utils.data.Dataset):
                                                                         drop_last)
             self.batches_per_epoch = batches_per_epoch
 
-    def compute_similarity_with_lcs(self,hist, neighbor_hist, threshold=0.25 ):
-        def lcs_with_threshold(A, B, threshold):
-            m, n = len(A), len(B)
-            dp = np.zeros((m + 1, n + 1), dtype=int)
-            for i in range(1, m + 1):
-                for j in range(1, n + 1):
-                    if np.linalg.norm(A[i - 1, :2] - B[j - 1, :2]) <= threshold:
-                        dp[i][j] = dp[i - 1][j - 1] + 1
-                    else:
-                        dp[i][j] = max(dp[i - 1][j], dp[i][j - 1])
-            return dp[m][n]
-
-        similarities = []
-        for neighbor in neighbor_hist.T:
-            sim = lcs_with_threshold(hist[:, :2], neighbor[:self.ob_horizon, :2], threshold)
-            similarities.append(sim / min(len(hist), self.ob_horizon))
-        return np.array(similarities)
-    def collate_fn(self, batch):
-        X, Y, NEIGHBOR, SIMILARITY = [], [], [], []
-        for item in batch:
-            hist, future, neighbor = item[0], item[1], item[2]
-
-            neighbor_hist = neighbor[:self.ob_horizon]
-            sim = self.compute_similarity_with_lcs(hist, neighbor_hist)
-            hist_shape = hist.shape
-            neighbor_shape = neighbor.shape
-            hist = np.reshape(hist, (-1, 2))
-            neighbor = np.reshape(neighbor, (-1, 2))
-
-            if self.flip:
-                if self.rng.randint(2):
-                    hist[..., 1] *= -1
-                    future[..., 1] *= -1
-                    neighbor[..., 1] *= -1
-                if self.rng.randint(2):
-                    hist[..., 0] *= -1
-                    future[..., 0] *= -1
-                    neighbor[..., 0] *= -1
-            if self.rotate:
-                rot = self.rng.random() * (np.pi + np.pi)
-                s, c = np.sin(rot), np.cos(rot)
-                r = np.asarray([
-                    [c, -s],
-                    [s, c]
-                ])
-                hist = (r @ np.expand_dims(hist, -1)).squeeze(-1)
-                future = (r @ np.expand_dims(future, -1)).squeeze(-1)
-                neighbor = (r @ np.expand_dims(neighbor, -1)).squeeze(-1)
-            if self.scale:
-                s = self.rng.randn() * 0.05 + 1  # N(1, 0.05)
-                hist = s * hist
-                future = s * future
-                neighbor = s * neighbor
-            hist = np.reshape(hist, hist_shape)
-            neighbor = np.reshape(neighbor, neighbor_shape)
-            X.append(hist)
-            Y.append(future)
-            NEIGHBOR.append(neighbor)
-            SIMILARITY.append(sim)
+    CACHE_VERSION = 3
+
+    def cache_key(self, filename, inclusive_groups):
+        h = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        h.update(repr((
+            self.CACHE_VERSION, self.ob_horizon, self.pred_horizon, self.frameskip,
+            sorted(map(str, inclusive_groups)) if inclusive_groups else [], self.neighbor_radius
+        )).encode())
+        return h.hexdigest()
+
+    def world_scale(self, scale):
+        # the WORLD_SCALE of a config for every sample: one number for all of them, one value
+        # per sample, or a dict of values per scene, by file name without extension
+        if isinstance(scale, dict):
+            missing = sorted(set(self.scene_names) - set(scale))
+            if missing:
+                raise ValueError("No WORLD_SCALE for scene(s): {}".format(", ".join(missing)))
+            return np.array([scale[name] for name in self.scene_names], dtype=np.float32)[self.sample_file]
+        scale = np.asarray(scale, dtype=np.float32)
+        if scale.ndim and len(scale) != len(self):
+            raise ValueError("WORLD_SCALE has {} values for {} samples".format(len(scale), len(self)))
+        return np.broadcast_to(scale, (len(self),))
+
+    def empty_columns(self):
+        columns = dict(
+            scene=np.empty((0, self.horizon, 6), dtype=np.float32),
+            scene_offsets=np.zeros(1, dtype=int),
+            window=np.empty(0, dtype=int),
+            agent=np.empty(0, dtype=int)
+        )
+        if self.neighbor_radius is not None:
+            columns["neighbor"] = np.empty(0, dtype=int)
+            columns["neighbor_offsets"] = np.zeros(1, dtype=int)
+        return columns
+
+    def merge_columns(self, data):
+        if not data: return self.empty_columns()
+        n_agents = [np.diff(d["scene_offsets"]) for d in data]
+        n_windows = np.cumsum([0] + [len(n) for n in n_agents])
+        columns = dict(
+            scene=np.concatenate([d["scene"] for d in data]),
+            scene_offsets=np.concatenate([[0]] + n_agents).cumsum(),
+            window=np.concatenate([d["window"] + w for d, w in zip(data, n_windows)]),
+            agent=np.concatenate([d["agent"] for d in data])
+        )
+        if self.neighbor_radius is not None:
+            # neighbor indices are relative to their window and need no shift
+            columns["neighbor"] = np.concatenate([d["neighbor"] for d in data])
+            columns["neighbor_offsets"] = np.concatenate(
+                [[0]] + [np.diff(d["neighbor_offsets"]) for d in data]).cumsum()
+        return columns
+
+    def save_cache(self, path, columns):
+        tmp = "{}.tmp{}".format(path, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name, value in columns.items():
+            np.save(os.path.join(tmp, name + ".npy"), value)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # written concurrently by another process
+            shutil.rmtree(tmp, ignore_errors=True)
 
+    def load_cache(self, path):
+        columns = {
+            name: np.load(os.path.join(path, name + ".npy"))
+            for name in ("scene_offsets", "window", "agent") + \
+                (() if self.neighbor_radius is None else ("neighbor", "neighbor_offsets"))
+        }
+        if len(columns["window"]) == 0: return self.empty_columns()
+        columns["scene"] = np.load(os.path.join(path, "scene.npy"), mmap_mode="r")
+        return columns
+
+    def collate_fn(self, batch):
+        X, Y, NEIGHBOR = zip(*batch)
         n_neighbors = [n.shape[1] for n in NEIGHBOR]
-        max_neighbors = max(n_neighbors)
-        if max_neighbors != min(n_neighbors):
-            NEIGHBOR = [
-                np.pad(neighbor, ((0, 0), (0, max_neighbors - n), (0, 0)),
-                       "constant", constant_values=1e9)
-                for neighbor, n in zip(NEIGHBOR, n_neighbors)
-            ]
         stack_dim = 0 if self.batch_first else 1
         x = np.stack(X, stack_dim)
         y = np.stack(Y, stack_dim)
-        neighbor = np.stack(NEIGHBOR, stack_dim)
+        neighbor = np.full((len(batch), self.horizon, max(n_neighbors), 6), 1e9, dtype=np.float32)
+        for i, (n, nb) in enumerate(zip(n_neighbors, NEIGHBOR)):
+            neighbor[i, :, :n] = nb
+        if not self.batch_first:
+            neighbor = neighbor.swapaxes(0, 1)
+
+        device = torch.device("cpu") if self.cpu_collate else self.device
+        x = torch.tensor(x, dtype=torch.float32, device=device)
+        y = torch.tensor(y, dtype=torch.float32, device=device)
+        neighbor = torch.tensor(neighbor, dtype=torch.float32, device=device)
+        if self.flip or self.rotate or self.scale:
+            x, y, neighbor = self.augment(x, y, neighbor)
+        return x, y, neighbor
+
+    def augment(self, x, y, neighbor):
+        # One 2 x 2 transform per sample, scale * rotation * flip, applied to
+        # position, velocity and acceleration of the agent and its neighbors.
+        B = x.size(0 if self.batch_first else 1)
+        fx, fy, c, s, scale = np.ones(B), np.ones(B), np.ones(B), np.zeros(B), np.ones(B)
+        if self.flip:
+            fy = 1 - 2. * self.rng.randint(2, size=B)
+            fx = 1 - 2. * self.rng.randint(2, size=B)
+        if self.rotate:
+            rot = self.rng.random(B) * (np.pi + np.pi)
+            c, s = np.cos(rot), np.sin(rot)
+        if self.scale:
+            scale = self.rng.randn(B) * 0.05 + 1  # N(1, 0.05)
+        r = np.stack((
+            np.stack((c * fx, -s * fy), -1),
+            np.stack((s * fx, c * fy), -1)
+        ), -2) * scale[:, None, None]  # B x 2 x 2
+        r = torch.tensor(r, dtype=x.dtype, device=x.device)
 
-        x = torch.tensor(x, dtype=torch.float32, device=self.device)
-        y = torch.tensor(y, dtype=torch.float32, device=self.device)
-        neighbor = torch.tensor(neighbor, dtype=torch.float32, device=self.device)
-        SIMILARITY = torch.tensor(SIMILARITY, dtype=torch.float32, device=self.device)
-        return x, y, neighbor, SIMILARITY
+        b = "bl" if self.batch_first else "lb"
+        # sentinel rows of absent neighbors keep their value
+        pad = neighbor[..., :1] >= 1e9
+        x = torch.einsum("bij,{}kj->{}ki".format(b, b), r, x.view(*x.shape[:-1], 3, 2)).reshape(x.shape)
+        y = torch.einsum("bij,{}j->{}i".format(b, b), r, y)
+        neighbor = torch.einsum("bij,{}nkj->{}nki".format(b, b), r, neighbor.view(*neighbor.shape[:-1], 3, 2))
+        neighbor = neighbor.reshape(pad.shape[:-1] + (6,)).masked_fill(pad, 1e9)
+        return x, y, neighbor
+
+    def to_device(self, batch):
+        # asynchronous when the DataLoader returns pinned memory
+        return [t.to(self.device, non_blocking=True) for t in batch]
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        # Forked workers inherit the same augmentation rng. Reseed it from the worker seed,
+        # which the DataLoader derives from the torch rng of the main process for every
+        # epoch, so that workers draw different augmentations and runs stay reproducible.
+        info = torch.utils.data.get_worker_info()
+        info.dataset.rng.seed(info.seed % 2**32)
 
 
 
     def __len__(self):
-        return len(self.data)
+        return len(self.sample_window)
+
+    def n_neighbors(self):
+        # number of neighbor columns of each sample, including the sentinel of a lone agent
+        if self.neighbor_offsets is None:
+            return np.diff(self.scene_offsets)[self.sample_window] - 1
+        return np.diff(self.neighbor_offsets)
 
     def __getitem__(self, idx):
-        return self.data[idx]
+        w = self.sample_window[idx]
+        scene = self.scene[self.scene_offsets[w]:self.scene_offsets[w + 1]]
+        if self.neighbor_index is None:
+            agent, neighbor = self.split_scene(scene, self.sample_agent[idx])
+        else:
+            agent = scene[self.sample_agent[idx]]
+            neighbor = scene[self.neighbor_index[self.neighbor_offsets[idx]:self.neighbor_offsets[idx + 1]]]
+            neighbor = neighbor.swapaxes(0, 1)
+        return agent[:self.ob_horizon], agent[self.ob_horizon:, :2], neighbor
+
+    @staticmethod
+    def split_scene(scene, i):
+        # scene: N x L x 6
+        # agent: L x 6
+        # neighbor: L x (N-1) x 6
+        neighbor = np.concatenate((scene[:i], scene[i + 1:])).swapaxes(0, 1)
+        return scene[i], neighbor
 
     @staticmethod
     def load(self, filename, inclusive_groups):
@@ -200,134 +421,194 @@ class Dataloader(torch.utils.data.Dataset):
 
         horizon = (self.horizon - 1) * self.frameskip
         with open(filename, "r") as record:
-            data = self.load_traj(record)
-        data = self.extend(data, self.frameskip)
-        time = np.sort(list(data.keys()))
+            data = self.load_traj(record, with_groups=bool(inclusive_groups))
+        time, traj = self.extend(data, self.frameskip)
         if len(time) < horizon + 1: return None
-        valid_horizon = self.ob_horizon + self.pred_horizon
-
-        traj = []
-        e = len(time)
-        tid0 = 0
-        while tid0 < e - horizon:
-            tid1 = tid0 + horizon
-            t0 = time[tid0]
-
-            idx = [aid for aid, d in data[t0].items() if
-                   not inclusive_groups or any(g in inclusive_groups for g in d[-1])]
-            if idx:
-                idx_all = list(data[t0].keys())
-                for tid in range(tid0 + self.frameskip, tid1 + 1, self.frameskip):
-                    t = time[tid]
-                    idx_cur = [aid for aid, d in data[t].items() if
-                               not inclusive_groups or any(g in inclusive_groups for g in d[-1])]
-                    if not idx_cur:
-                        tid0 = tid
-                        idx = []
-                        break
-                    idx = np.intersect1d(idx, idx_cur)
-                    if len(idx) == 0: break
-                    idx_all.extend(data[t].keys())
-            if len(idx):
-                data_dim = 6
-                neighbor_idx = np.setdiff1d(idx_all, idx)
-                if len(idx) == 1 and len(neighbor_idx) == 0:
-                    agents = np.array([
-                        [data[time[tid]][idx[0]][:data_dim]] + [[1e9] * data_dim]
-                        for tid in range(tid0, tid1 + 1, self.frameskip)
-                    ])  # L x 2 x 6
-                else:
-                    agents = np.array([
-                        [data[time[tid]][i][:data_dim] for i in idx] +
-                        [data[time[tid]][j][:data_dim] if j in data[time[tid]] else [1e9] * data_dim for j in
-                         neighbor_idx]
-                        for tid in range(tid0, tid1 + 1, self.frameskip)
-                    ])  # L X N x 6
-                for i in range(len(idx)):
-                    hist = agents[:self.ob_horizon, i]  # L_ob x 6
-                    future = agents[self.ob_horizon:valid_horizon, i, :2]  # L_pred x 2
-                    neighbor = agents[:valid_horizon, [d for d in range(agents.shape[1]) if d != i]]  # L x (N-1) x 6
-                    traj.append((hist, future, neighbor))
-            tid0 += 1
-
-        items = []
-        for hist, future, neighbor in traj:
-            hist = np.float32(hist)
-            future = np.float32(future)
-            neighbor = np.float32(neighbor)
-            items.append((hist, future, neighbor))
-        return items
+
+        # occupancy: record index of every (frame, agent), -1 if absent
+        agent_ids, aid = np.unique(traj["id"], return_inverse=True)
+        record = np.full((len(time), len(agent_ids)), -1)
+        record[traj["frame"], aid] = np.arange(len(traj))
+        present = record >= 0
+        if inclusive_groups:
+            group, gid = np.unique(traj["group"], return_inverse=True)
+            selected = np.array([bool(g) and any(n in inclusive_groups for n in g.split("/")) for g in group])
+            included = np.zeros_like(present)
+            included[traj["frame"], aid] = selected[gid]
+        else:
+            included = present
+
+        # For each start frame, count over the window frames (start, start + frameskip, ..., start + horizon)
+        # how often every agent is present and included. Full agents become samples; the rest of the
+        # agents seen in the window become their neighbors.
+        n_starts = len(time) - horizon
+        full = self.window_count(included, n_starts) == self.horizon  # n_starts x A
+        seen = self.window_count(present, n_starts) > 0
+        starts = np.flatnonzero(full.any(1))
+        full, seen = full[starts], seen[starts] & ~full[starts]
+        if not len(starts): return None
+
+        # columns of each window: full agents, then neighbors, both by agent id; a lone agent
+        # without any neighbor gets a sentinel column
+        fw, fa = np.nonzero(full)
+        nw, na = np.nonzero(seen)
+        n_full = np.bincount(fw, minlength=len(starts))
+        sw = np.flatnonzero((n_full == 1) & ~seen.any(1))
+        col_w = np.concatenate((fw, nw, sw))
+        col_a = np.concatenate((fa, na, np.full(len(sw), -1)))
+        order = np.lexsort((col_a, np.repeat([0, 1, 2], [len(fw), len(nw), len(sw)]), col_w))
+        col_w, col_a = col_w[order], col_a[order]
+
+        frames = starts[col_w, None] + np.arange(0, horizon + 1, self.frameskip)  # N x L
+        idx = np.where(col_a[:, None] >= 0, record[frames, col_a[:, None]], -1)
+        features = np.stack([traj[k] for k in ("x", "y", "vx", "vy", "ax", "ay")], -1)
+        features = np.concatenate((features, np.full((1, 6), 1e9)))  # index -1 is the sentinel
+        scene_offsets = np.concatenate(([0], np.bincount(col_w, minlength=len(starts)).cumsum()))
+        window = np.repeat(np.arange(len(starts)), n_full)
+        columns = dict(
+            scene=np.float32(features[idx]),  # N x L x 6
+            scene_offsets=scene_offsets,
+            window=window,
+            agent=np.arange(len(window)) - np.repeat(np.cumsum(n_full) - n_full, n_full)
+        )
+        if self.neighbor_radius is not None:
+            columns["neighbor_offsets"], columns["neighbor"] = self.prune_neighbors(
+                traj, aid, starts, n_starts, col_w, col_a, scene_offsets, n_full)
+        return columns
+
+    def prune_neighbors(self, traj, aid, starts, n_starts, col_w, col_a, scene_offsets, n_full):
+        # Keep, for every sample, the window columns of the agents that come within
+        # neighbor_radius of it in at least one of the window frames. Close pairs are
+        # found per frame with a uniform grid of cell size neighbor_radius, so only
+        # agents in the 3 x 3 surrounding cells are compared.
+        r = self.neighbor_radius
+        # slightly widened so that float rounding never drops a neighbor the model would keep
+        r2 = (r * (1 + 1e-5)) ** 2
+        pos = np.stack((traj["x"], traj["y"]), -1).astype(np.float32).astype(np.float64)
+        cell = np.floor(pos / r).astype(np.int64)
+        cell -= cell.min(0) - 1
+        W, H = cell.max(0) + 2
+        key = (traj["frame"] * W + cell[:, 0]) * H + cell[:, 1]
+        order = np.argsort(key, kind="stable")
+        key_sorted = key[order]
+        I, J = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                target = key + dx * H + dy
+                lo = np.searchsorted(key_sorted, target, "left")
+                n = np.searchsorted(key_sorted, target, "right") - lo
+                i = np.repeat(np.arange(len(key)), n)
+                j = order[np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())]
+                close = (i != j) & (np.square(pos[i] - pos[j]).sum(-1) <= r2)
+                I.append(i[close])
+                J.append(j[close])
+        I, J = np.concatenate(I), np.concatenate(J)
+
+        # windows whose frames contain the frame of each close pair
+        start_window = np.full(n_starts, -1)
+        start_window[starts] = np.arange(len(starts))
+        s = traj["frame"][I, None] - np.arange(0, self.horizon * self.frameskip, self.frameskip)
+        w = np.where((s >= 0) & (s < n_starts), start_window[s.clip(0, n_starts - 1)], -1)
+        pair, l = np.nonzero(w >= 0)
+        w = w[pair, l]
+
+        # window columns of both agents; the first one must be a sample agent
+        n_agents = aid.max() + 1 if len(aid) else 1
+        real = col_a >= 0
+        col_key = col_w[real] * n_agents + col_a[real]
+        col_idx = (np.arange(len(col_w)) - scene_offsets[col_w])[real]
+        col_order = np.argsort(col_key)
+        col_key, col_idx = col_key[col_order], col_idx[col_order]
+        ci = col_idx[np.searchsorted(col_key, w * n_agents + aid[I[pair]])]
+        cj = col_idx[np.searchsorted(col_key, w * n_agents + aid[J[pair]])]
+        sample_base = np.cumsum(n_full) - n_full
+        is_sample = ci < n_full[w]
+        sample, neighbor = np.unique(np.stack((sample_base[w] + ci, cj), -1)[is_sample], axis=0).T \
+            if is_sample.any() else (np.empty(0, dtype=int), np.empty(0, dtype=int))
+        neighbor_offsets = np.concatenate(([0], np.bincount(sample, minlength=n_full.sum()).cumsum()))
+        return neighbor_offsets, neighbor
+
+    def window_count(self, mask, n_starts):
+        # mask: T x A
+        # returns n_starts x A counts of mask over frames start, start + frameskip, ..., start + horizon
+        fs = self.frameskip
+        T = mask.shape[0]
+        pad = -T % fs
+        count = np.concatenate((mask, np.zeros((pad, mask.shape[1]), dtype=mask.dtype))).astype(np.int32)
+        count = count.reshape(-1, fs, mask.shape[1]).cumsum(0).reshape(-1, mask.shape[1])
+        count = np.concatenate((np.zeros((fs, mask.shape[1]), dtype=np.int32), count))
+        start = np.arange(n_starts)
+        return count[start + self.horizon * fs] - count[start]
 
     def extend(self, data, frameskip):
-        time = np.sort(list(data.keys()))
+        # data: records from load_traj
+        # returns the frame grid and the records that have a neighbor record of
+        # the same agent frameskip frames before or after, sorted by agent and
+        # frame, with velocity and acceleration attached
+        time = np.unique(data["t"])
+        if len(time) < 2:
+            return time, np.empty(0, dtype=self.KINEMATICS_DTYPE + [("group", data.dtype["group"])])
         dts = np.unique(time[1:] - time[:-1])
         dt = dts.min()
         if np.any(dts % dt != 0):
             raise ValueError("Inconsistent frame interval:", dts)
-        i = 0
-        while i < len(time) - 1:
-            if time[i + 1] - time[i] != dt:
-                time = np.insert(time, i + 1, time[i] + dt)
-            i += 1
-        for tid, t in enumerate(time):
-            removed = []
-            if t not in data: data[t] = {}
-            for idx in data[t].keys():
-                t0 = time[tid - frameskip] if tid >= frameskip else None
-                t1 = time[tid + frameskip] if tid + frameskip < len(time) else None
-                if (t0 is None or t0 not in data or idx not in data[t0]) and \
-                        (t1 is None or t1 not in data or idx not in data[t1]):
-                    removed.append(idx)
-            for idx in removed:
-                data[t].pop(idx)
-
-        for tid in range(len(time) - frameskip):
-            t0 = time[tid]
-            t1 = time[tid + frameskip]
-            if t1 not in data or t0 not in data: continue
-            for i, item in data[t1].items():
-                if i not in data[t0]: continue
-                x0 = data[t0][i][0]
-                y0 = data[t0][i][1]
-                x1 = data[t1][i][0]
-                y1 = data[t1][i][1]
-                vx, vy = x1 - x0, y1 - y0
-                data[t1][i].insert(2, vx)
-                data[t1][i].insert(3, vy)
-                if tid < frameskip or i not in data[time[tid - 1]]:
-                    data[t0][i].insert(2, vx)
-                    data[t0][i].insert(3, vy)
-
-        for tid in range(len(time) - frameskip):
-            t_1 = None if tid < frameskip else time[tid - frameskip]
-            t0 = time[tid]
-            t1 = time[tid + frameskip]
-            if t1 not in data or t0 not in data: continue
-            for i, item in data[t1].items():
-                if i not in data[t0]: continue
-                vx0 = data[t0][i][2]
-                vy0 = data[t0][i][3]
-                vx1 = data[t1][i][2]
-                vy1 = data[t1][i][3]
-                ax, ay = vx1 - vx0, vy1 - vy0
-                data[t1][i].insert(4, ax)
-                data[t1][i].insert(5, ay)
-                if t_1 is None or i not in data[t_1]:
-                    data[t0][i].insert(4, ax)
-                    data[t0][i].insert(5, ay)
-        return data
+        time = np.arange(time[0], time[-1] + dt, dt)
+        frame = (data["t"] - time[0]) // dt
 
-    def load_traj(self, file):
-        data = {}
-        for row in file.readlines():
-            item = row.split()
-            if not item: continue
-            t = int(float(item[0]))
-            idx = int(float(item[1]))
-            x = float(item[2])
-            y = float(item[3])
-            group = item[4].split("/") if len(item) > 4 else None
-            if t not in data:
-                data[t] = {}
-            data[t][idx] = [x, y, group]
-        return data
\ No newline at end of file
+        # one record per (agent, frame), the last one in the file wins
+        _, aid = np.unique(data["id"], return_inverse=True)
+        stride = len(time) + frameskip + frameskip
+        key = aid * stride + frame
+        order = np.lexsort((-np.arange(len(key)), key))
+        key, first = np.unique(key[order], return_index=True)
+        data, frame = data[order[first]], frame[order[first]]
+
+        def lookup(k):
+            i = np.searchsorted(key, k).clip(max=len(key) - 1)
+            return i, key[i] == k
+        prev, has_prev = lookup(key - frameskip)
+        succ, has_succ = lookup(key + frameskip)
+        # isolated records have nothing to take a difference with
+        keep = has_prev | has_succ
+        remap = np.cumsum(keep) - 1
+        prev, has_prev = remap[prev[keep]], has_prev[keep]
+        succ = remap[succ[keep]]
+        data, frame = data[keep], frame[keep]
+
+        res = np.empty(len(data), dtype=self.KINEMATICS_DTYPE + [("group", data.dtype["group"])])
+        res["frame"] = frame
+        for k in ("t", "id", "x", "y", "group"):
+            res[k] = data[k]
+        # backward differences; the first record of a track takes the forward
+        # difference of its successor instead
+        for p, v in (("x", "vx"), ("y", "vy")):
+            res[v] = np.where(has_prev, res[p] - res[p][prev], res[p][succ] - res[p])
+        for v, a in (("vx", "ax"), ("vy", "ay")):
+            res[a] = np.where(has_prev, res[v] - res[v][prev], res[v][succ] - res[v])
+        return time, res
+
+    TRAJ_DTYPE = [("t", np.int64), ("id", np.int64), ("x", np.float64), ("y", np.float64)]
+    KINEMATICS_DTYPE = [("frame", np.int64)] + TRAJ_DTYPE + [
+        ("vx", np.float64), ("vy", np.float64), ("ax", np.float64), ("ay", np.float64)
+    ]
+
+    def load_traj(self, file, with_groups=False):
+        # columns: frame, agent id, x, y[, group names separated by "/"]
+        # the group field keeps the raw "/"-separated names, empty if absent
+        text = file.read()
+        if not text.strip(): return np.empty(0, dtype=self.TRAJ_DTYPE + [("group", "U1")])
+        values = np.loadtxt(io.StringIO(text), usecols=(0, 1, 2, 3), ndmin=2)
+        if with_groups:
+            group = np.array([
+                item[4] if len(item) > 4 else ""
+                for item in map(str.split, text.splitlines()) if item
+            ])
+        else:
+            group = np.zeros(len(values), dtype="U1")
+        data = np.empty(len(values), dtype=self.TRAJ_DTYPE + [("group", group.dtype)])
+        data["t"] = values[:, 0].astype(np.int64)
+        data["id"] = values[:, 1].astype(np.int64)
+        data["x"] = values[:, 2]
+        data["y"] = values[:, 3]
+        data["group"] = group
+        return data
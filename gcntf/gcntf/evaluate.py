@@ -0,0 +1,161 @@
+import os, sys, time
+import json
+import importlib
+import argparse
+import concurrent.futures
+import torch
+import torch.multiprocessing
+from gcntf import gcntf
+from data import Dataloader
+from utils import FPC_ADE_FDE, seed, get_rng_state, set_rng_state
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--job", nargs="+", action="append", required=True, metavar="CONFIG CKPT TEST",
+                    help="a config, a checkpoint file or directory with ckpt-best, and test files or directories")
+parser.add_argument("--output", type=str, default=None)
+parser.add_argument("--workers", type=int, default=None)
+parser.add_argument("--fpc-search", action="store_true", default=False)
+parser.add_argument("--no-fpc", action="store_true", default=False)
+parser.add_argument("--frameskip", type=int, default=1)
+parser.add_argument("--cache", type=str, default=None)
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--enc-mode", type=str, default="loop", choices=["loop", "packed"])
+
+
+def evaluate(model, dataset, fpc_range, pred_samples):
+    # per-sample ADE and FDE for every fpc value, in dataset order
+    # smaller fpc values cluster a prefix of the samples drawn for the largest one
+    ADE, FDE = {f: [] for f in fpc_range}, {f: [] for f in fpc_range}
+    model.eval()
+    with torch.no_grad():
+        for idx in dataset.batch_sampler:
+            x, y, neighbor = dataset.collate_fn([dataset[i] for i in idx])
+            h = model.encode(x, neighbor)
+            pool = model.sample(h, pred_samples * max(fpc_range)) + x[-1, ..., :2]
+            for f in fpc_range:
+                ade, fde = FPC_ADE_FDE(pool, y, pred_samples, f)
+                ADE[f].append(ade)
+                FDE[f].append(fde)
+    return {f: (torch.cat(ADE[f]).cpu().numpy(), torch.cat(FDE[f]).cpu().numpy()) for f in fpc_range}
+
+
+checkpoints = None
+
+
+def init_worker(states, n_threads):
+    # checkpoints arrive once per worker, in shared memory
+    global checkpoints
+    checkpoints = states
+    torch.set_num_threads(n_threads)
+    sys.stdout = open(os.devnull, "w")
+
+
+def run_job(config_file, ckpt, files, settings):
+    tic = time.time()
+    # configs may read their test paths from the command line, as config/sdd_pixel.py does
+    sys.argv = [sys.argv[0], "--test"] + list(files)
+    spec = importlib.util.spec_from_file_location("config", config_file)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+
+    seed(settings.seed)
+    # the state main.py restores before every evaluation, so that results match main.py --test
+    init_rng_state = get_rng_state("cpu")
+    if config.INCLUSIVE_GROUPS is not None:
+        inclusive = [config.INCLUSIVE_GROUPS for _ in range(len(files))]
+    else:
+        inclusive = None
+    dataset = Dataloader(
+        files, ob_horizon=config.OB_HORIZON, pred_horizon=config.PRED_HORIZON, frameskip=settings.frameskip,
+        batch_size=config.BATCH_SIZE, shuffle=False, drop_last=False, inclusive_groups=inclusive,
+        device=torch.device("cpu"), seed=settings.seed, cache_dir=settings.cache
+    )
+    model = gcntf(horizon=config.PRED_HORIZON, ob_radius=config.OB_RADIUS, hidden_dim=config.RNN_HIDDEN_DIM,
+                  enc_mode=settings.enc_mode)
+    model.load_state_dict(checkpoints[ckpt]["model"])
+    if settings.no_fpc:
+        fpc_range = [1]
+    elif settings.fpc_search:
+        fpc_range = list(config.FPC_SEARCH_RANGE)
+    else:
+        fpc_range = [checkpoints[ckpt]["fpc"]]
+    set_rng_state(init_rng_state, "cpu")
+    errors = evaluate(model, dataset, fpc_range, config.PRED_SAMPLES)
+
+    scale = dataset.world_scale(config.WORLD_SCALE)
+    scenes = [(name, dataset.sample_file == i) for i, name in enumerate(dataset.scene_names)]
+    results = []
+    for f in fpc_range:
+        ade, fde = errors[f][0] * scale, errors[f][1] * scale
+        results.append(dict(
+            fpc=f, ADE=float(ade.mean()), FDE=float(fde.mean()),
+            scenes={
+                name: dict(samples=int(mask.sum()), ADE=float(ade[mask].mean()), FDE=float(fde[mask].mean()))
+                for name, mask in scenes if mask.any()
+            }
+        ))
+    best = min(results, key=lambda r: r["ADE"] + r["FDE"])
+    return dict(samples=len(dataset), fpc=best["fpc"], ADE=best["ADE"], FDE=best["FDE"],
+                results=results, time=time.time() - tic)
+
+
+if __name__ == "__main__":
+    settings = parser.parse_args()
+    for job in settings.job:
+        if len(job) < 3:
+            parser.error("--job takes a config, a checkpoint and at least one test path, got {}".format(job))
+        if not os.path.exists(job[1]):
+            parser.error("Checkpoint not found: {}".format(job[1]))
+
+    # every checkpoint is loaded once and shared with all workers
+    states = {}
+    for _, ckpt, *_ in settings.job:
+        if ckpt in states: continue
+        filename = os.path.join(ckpt, "ckpt-best") if os.path.isdir(ckpt) else ckpt
+        print("Load from ckpt:", filename)
+        state_dict = torch.load(filename, map_location="cpu")
+        states[ckpt] = dict(model=state_dict["model"], fpc=int(state_dict.get("fpc", 1)))
+        for v in states[ckpt]["model"].values():
+            v.share_memory_()
+
+    workers = settings.workers or min(len(settings.job), os.cpu_count() or 1)
+    n_threads = max(1, torch.get_num_threads() // workers)
+    report = dict(jobs=[])
+    failed = False
+    tic = time.time()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=torch.multiprocessing.get_context("spawn"),
+            initializer=init_worker, initargs=(states, n_threads)) as pool:
+        futures = [pool.submit(run_job, config_file, ckpt, files, settings)
+                   for config_file, ckpt, *files in settings.job]
+        for done, _ in enumerate(concurrent.futures.as_completed(futures)):
+            sys.stdout.write("\r\033[K Evaluating...{}/{} -- time: {}s".format(
+                done + 1, len(futures), int(time.time() - tic)))
+        print()
+        for (config_file, ckpt, *files), future in zip(settings.job, futures):
+            entry = dict(config=config_file, ckpt=ckpt, test=files)
+            try:
+                entry.update(future.result())
+            except Exception as e:
+                entry["error"] = "{}: {}".format(type(e).__name__, e)
+                failed = True
+            report["jobs"].append(entry)
+
+    for entry in report["jobs"]:
+        name = os.path.splitext(os.path.basename(entry["config"]))[0]
+        if "error" in entry:
+            print(" {}: {}".format(name, entry["error"]))
+            continue
+        fpc_config = "FPC: {}".format(entry["fpc"]) if entry["fpc"] > 1 else "w/o FPC"
+        print(" {}: ADE: {:.4f}; FDE: {:.4f} ({}) -- {} samples, time: {}s".format(
+            name, entry["ADE"], entry["FDE"], fpc_config, entry["samples"], int(entry["time"])))
+        result = next(r for r in entry["results"] if r["fpc"] == entry["fpc"])
+        for scene, r in result["scenes"].items():
+            print("   {}: ADE: {:.4f}; FDE: {:.4f} -- {} samples".format(scene, r["ADE"], r["FDE"], r["samples"]))
+    if settings.output:
+        with open(settings.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(" Report written to {}".format(settings.output))
+    else:
+        print(json.dumps(report))
+    sys.exit(1 if failed else 0)
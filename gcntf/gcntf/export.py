@@ -0,0 +1,118 @@
+import os, time
+import json
+import importlib
+import argparse
+import torch
+from gcntf import gcntf
+from benchmark import random_scene
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config", type=str, default=None)
+parser.add_argument("--ckpt", type=str, default=None)
+parser.add_argument("--output", type=str, default=None)
+parser.add_argument("--samples", type=int, default=None)
+parser.add_argument("--max-agents", type=int, default=4096)
+parser.add_argument("--max-neighbors", type=int, default=1024)
+parser.add_argument("--device", type=str, default="cpu")
+parser.add_argument("--repeat", type=int, default=20)
+parser.add_argument("--seed", type=int, default=1)
+
+
+class Predictor(torch.nn.Module):
+    # the inference graph with a fixed number of samples:
+    # (x: L1 x N x 6, neighbor: L1 x N x Nn x 6) -> K x L2 x N x 2
+    def __init__(self, model, n_samples):
+        super().__init__()
+        self.model = model
+        self.n_samples = n_samples
+
+    def forward(self, x, neighbor):
+        with torch.no_grad():
+            return self.model.predict(x, neighbor, self.n_samples)
+
+
+def export(model, n_samples, ob_horizon, max_agents, max_neighbors, rng):
+    # dynamic in the number of agents and neighbors, static in the horizons and the number of samples
+    predictor = Predictor(model, n_samples).eval()
+    x, neighbor = random_scene(8, 4, ob_horizon, rng)
+    device = next(model.parameters()).device
+    x, neighbor = x.to(device), neighbor.to(device)
+    N = torch.export.Dim("N", min=2, max=max_agents)
+    Nn = torch.export.Dim("Nn", min=1, max=max_neighbors)
+    return torch.export.export(predictor, (x, neighbor), dynamic_shapes=({1: N}, {1: N, 2: Nn}))
+
+
+def load(filename, device=None):
+    # needs neither this file nor the model code
+    # returns the predictor callable and the metadata saved with it
+    extra_files = {"meta.json": ""}
+    program = torch.export.load(filename, extra_files=extra_files)
+    predictor = program.module()
+    if device is not None: predictor.to(device)
+    return predictor, json.loads(extra_files["meta.json"])
+
+
+if __name__ == "__main__":
+    settings = parser.parse_args()
+    spec = importlib.util.spec_from_file_location("config", settings.config)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    settings.device = torch.device(settings.device)
+
+    # the packed encoder mode is data-dependent and cannot be exported
+    model = gcntf(horizon=config.PRED_HORIZON, ob_radius=config.OB_RADIUS, hidden_dim=config.RNN_HIDDEN_DIM)
+    fpc = 1
+    if settings.ckpt:
+        ckpt = settings.ckpt
+        if os.path.isdir(ckpt):
+            ckpt = os.path.join(ckpt, "ckpt-best")
+        print("Load from ckpt:", ckpt)
+        state_dict = torch.load(ckpt, map_location="cpu")
+        model.load_state_dict(state_dict["model"])
+        if "fpc" in state_dict: fpc = int(state_dict["fpc"])
+    model.to(settings.device).eval()
+    # candidates for FPC, which picks PRED_SAMPLES of them on the caller's side
+    n_samples = settings.samples or config.PRED_SAMPLES * fpc
+    if settings.output is None:
+        settings.output = os.path.join(settings.ckpt or ".", "gcntf.pt2")
+    elif os.path.splitext(settings.output)[1] != ".pt2":
+        parser.error("--output must be a .pt2 file, got {}".format(settings.output))
+
+    rng = torch.Generator().manual_seed(settings.seed)
+    tic = time.time()
+    program = export(model, n_samples, config.OB_HORIZON, settings.max_agents, settings.max_neighbors, rng)
+    meta = dict(
+        ob_horizon=config.OB_HORIZON, pred_horizon=config.PRED_HORIZON, ob_radius=config.OB_RADIUS,
+        n_samples=n_samples, pred_samples=config.PRED_SAMPLES, fpc=fpc
+    )
+    torch.export.save(program, settings.output, extra_files={"meta.json": json.dumps(meta)})
+    print(" Exported to {} in {:.1f}s: {}".format(settings.output, time.time() - tic, meta))
+
+    # The artifact is for deployment without this code; it is not faster than eager.
+    # Check it against the eager model with the same noise, and report the cold start,
+    # i.e. loading plus the first call, and the latency at a few batch sizes.
+    tic = time.perf_counter()
+    predictor, _ = load(settings.output, settings.device)
+    load_time = time.perf_counter() - tic
+    for i, n_agents in enumerate(sorted({1, 8, config.BATCH_SIZE})):
+        x, neighbor = random_scene(n_agents, 16, config.OB_HORIZON, rng)
+        x, neighbor = x.to(settings.device), neighbor.to(settings.device)
+
+        def eager():
+            with torch.no_grad():
+                return model.predict(x, neighbor, n_samples)
+
+        result = []
+        for fn in (eager, lambda: predictor(x, neighbor)):
+            torch.manual_seed(settings.seed)
+            tic = time.perf_counter()
+            result.append(fn())
+            result.append(time.perf_counter() - tic)
+            tic = time.perf_counter()
+            for _ in range(settings.repeat): fn()
+            result.append((time.perf_counter() - tic) / settings.repeat)
+        if i == 0:
+            print(" Cold start: load {:.2f}s, first call {:.2f}ms".format(load_time, result[4] * 1000))
+        print(" Batch of {}, {} samples: eager {:.2f}ms, exported {:.2f}ms; max abs diff {:.1e}".format(
+            n_agents, n_samples, result[2] * 1000, result[5] * 1000, (result[0] - result[3]).abs().max().item()
+        ))
@@ -1,6 +1,6 @@
 import torch
 from torch import nn
-from collections import deque
+
 
 class gcntf(torch.nn.Module):
     class DecoderZH(torch.nn.Module):
@@ -15,12 +15,6 @@ class gcntf(torch.nn.Module):
             self.mu = torch.nn.Linear(embed_dim, output_dim)
 
         def forward(self, z, h):
-            dim_0 = h.size(0)
-            dim_1 = h.size(1)
-            if dim_0 > 256:
-                h = h[0:256, :]
-            if dim_1 > 256:
-                h = h[:, 0:256]
             xy = self.embed(torch.cat((z, h), -1))
             loc = self.mu(xy)
             return loc
@@ -41,16 +35,11 @@ class gcntf(torch.nn.Module):
             )
 
         def forward(self, x):
-            dim_0 = x.size(0)
-            dim_1 = x.size(1)
-            if dim_0 > 256:
-                x = x[0:256, :]
-            if dim_1 > 256:
-                x = x[:, 0:256]
             x = self.embed(x)
             loc = self.mu(x)
             std = self.std(x)
-            return torch.distributions.Normal(loc, std)
+            # std is positive by construction; skipping the data-dependent check keeps the graph capturable
+            return torch.distributions.Normal(loc, std, validate_args=False)
 
     class Q_Z(torch.nn.Module):
         def __init__(self, hidden_dim_fy, hidden_dim_by, embed_dim, z_dim):
@@ -86,9 +75,14 @@ class gcntf(torch.nn.Module):
             code = torch.cat((z, d), -1)
             return self.embed_zd(code)
 
-    def __init__(self, horizon, ob_radius=2, hidden_dim=256):
+    def __init__(self, horizon, ob_radius=2, hidden_dim=256, enc_mode="loop"):
         super().__init__()
         self.ob_radius = ob_radius
+        # loop: attend over all neighbor slots, masked to those within ob_radius
+        # packed: attend over the neighbors within ob_radius only, stored without padding
+        self.enc_mode = enc_mode
+        # rows (samples x agents) decoded at once when sampling predictions
+        self.decode_rows = 32768
         self.horizon = horizon
         hidden_dim_fx = hidden_dim
         hidden_dim_fy = hidden_dim
@@ -102,14 +96,13 @@ class gcntf(torch.nn.Module):
         self.q_z = gcntf.Q_Z(hidden_dim_fy, hidden_dim_by, hidden_dim_fy, z_dim)
         self.p_z = gcntf.P_Z(hidden_dim_fy, hidden_dim_fy, z_dim)
         self.dec = gcntf.DecoderZH(z_dim, hidden_dim_fy, hidden_dim_fy, d_dim)
+        # Unused: the GCN/transformer branch these belonged to never reached the encoder
+        # state. They are kept only so that existing checkpoints load.
         self.gc_weight = torch.nn.Parameter(torch.randn(hidden_dim_fx, hidden_dim_fx))
         self.gc_bias = torch.nn.Parameter(torch.zeros(hidden_dim_fx))
-
-
         self.self_attn = nn.MultiheadAttention(embed_dim=hidden_dim, num_heads=8)
         self.st_attn = nn.MultiheadAttention(embed_dim=hidden_dim, num_heads=8)
         self.feature_transform = nn.Linear(6, hidden_dim)
-        self.gcn_outputs_queue = deque(maxlen=8)
         self.dim_reduction = nn.Linear(hidden_dim * 3, hidden_dim)
         self.zd_to_hidden = nn.Linear(in_features=32, out_features=hidden_dim)
         self.shape_adjust_linear = nn.Linear(1024, 128)
@@ -166,40 +159,71 @@ class gcntf(torch.nn.Module):
         # mask: N x Nn
         e = (k @ q.unsqueeze(-1)).squeeze(-1)  # N x Nn
         e = self.attention_nonlinearity(e)  # N x Nn
-        e[~mask] = -float("inf")
+        # the lowest finite value instead of -inf; masked entries get exactly 0 either way
+        e = e.masked_fill(~mask, torch.finfo(e.dtype).min)
         att = torch.nn.functional.softmax(e, dim=-1)  # N x Nn
-        return att.nan_to_num()
-
-    def gcn_layer(self, input, similarity):
-        if isinstance(similarity, list) and len(similarity) == 1:
-            similarity = similarity[0]
-        elif isinstance(similarity, torch.Tensor) and similarity.numel() == 1:
-            similarity = similarity.item()
-        similarity = torch.tensor(similarity, dtype=torch.float32)
-        weights = 1 - similarity
-        support = torch.einsum('bik,kj->bij', input, self.gc_weight[:input.size(-1), :input.size(-1)])
-
-        if self.gc_bias is not None:
-            bias_shape = self.gc_bias.size()
-            if bias_shape[0] != input.size(-1):
-                new_gc_bias_data = self.gc_bias[:input.size(-1)].detach().clone()
-                self.gc_bias.data = new_gc_bias_data.requires_grad_(True)
-            support = support + self.gc_bias.unsqueeze(0).unsqueeze(0)
-        weights = weights.mean(dim=-1, keepdim=True)
-        output = support * weights
-
-        return output
-
-
-    def enc(self, x, neighbor, *, y=None, similarity=None):
+        # agents without any neighbor in range get uniform rows; zero them with the masked entries
+        return att.masked_fill(~mask, 0)
+
+    def attention_packed(self, q, k, index):
+        # q: N x d
+        # k: P x d, keys of the neighbors in range only
+        # index: P, the agent each key belongs to
+        e = (k * q[index]).sum(-1)  # P
+        e = self.attention_nonlinearity(e)
+        e_max = torch.full_like(q[:, 0], -float("inf")).scatter_reduce(0, index, e, "amax")
+        e = (e - e_max[index]).exp()
+        return e / torch.zeros_like(e_max).index_add(0, index, e)[index]  # P
+
+    def fx_recurrence(self, h, k, n, s, mask):
+        # h: n_layers x N x d, k: L1 x N x Nn x d, n: L1 x N x Nn x d, s: L1 x N x d, mask: L1 x N x Nn
+        for t in range(k.size(0)):
+            q = self.embed_q(h[-1])  # N x d
+            att = self.attention(q, k[t], mask[t])  # N x Nn
+            x_t = att.unsqueeze(-2) @ n[t]  # N x 1 x d
+            x_t = x_t.squeeze(-2)  # N x d
+            x_t = torch.cat((x_t, s[t]), -1).unsqueeze(0)
+            _, h = self.rnn_fx(x_t, h)
+        return h
+
+    def fx_recurrence_packed(self, h, features, dpdv, s, mask):
+        # neighbors in packed layout: only the (frame, agent, neighbor) triples within ob_radius
+        # h: n_layers x N x d, features: L1 x N x Nn x 3, dpdv: L1 x N x Nn x 4, s: L1 x N x d, mask: L1 x N x Nn
+        t, i, _ = mask.nonzero(as_tuple=True)
+        k = self.embed_k(features[mask])  # P x d
+        n = self.embed_n(dpdv[mask])  # P x d
+        counts = torch.bincount(t, minlength=mask.size(0)).tolist()
+        for t, (k_t, n_t, i_t) in enumerate(zip(k.split(counts), n.split(counts), i.split(counts))):
+            q = self.embed_q(h[-1])  # N x d
+            att = self.attention_packed(q, k_t, i_t)  # P_t
+            x_t = q.new_zeros(q.size(0), n.size(-1)).index_add(0, i_t, att.unsqueeze(-1) * n_t)  # N x d
+            x_t = torch.cat((x_t, s[t]), -1).unsqueeze(0)
+            _, h = self.rnn_fx(x_t, h)
+        return h
+
+    @staticmethod
+    def social_features(dp, dv, v):
+        # dp, dv: ... x Nn x 2, neighbor positions and velocities relative to the agent
+        # v: ... x 2, the agent's velocity
+        # returns distance, bearing and minimal predicted distance, ... x Nn x 3
+        dist = dp.norm(dim=-1)  # ... x Nn
+        dot_dp_v = (dp @ v.unsqueeze(-1)).squeeze(-1)  # ... x Nn
+        bearing = dot_dp_v / (dist * v.norm(dim=-1).unsqueeze(-1))  # ... x Nn
+        bearing = bearing.nan_to_num(0, 0, 0)
+        dot_dp_dv = (dp.unsqueeze(-2) @ dv.unsqueeze(-1)).view(dist.shape)
+        tau = -dot_dp_dv / dv.norm(dim=-1)  # ... x Nn
+        tau = tau.nan_to_num(0, 0, 0).clip(0, 7)
+        mpd = (dp + tau.unsqueeze(-1) * dv).norm(dim=-1)  # ... x Nn
+        return torch.stack((dist, bearing, mpd), -1)
+
+    def enc(self, x, neighbor, *, y=None):
         # x: (L1+1) x N x 6
         # y: L2 x N x 2
         # neighbor: (L1+L2+1) x N x Nn x 6
-        global h_t
-        with torch.no_grad():
+        # geometry in full precision even under autocast
+        with torch.no_grad(), torch.autocast(x.device.type, enabled=False):
             L1 = x.size(0) - 1
             N = neighbor.size(1)
-            Nn = neighbor.size(2)
             state = x
 
             x = state[..., :2]  # (L1+1) x N x 2
@@ -213,6 +237,10 @@ class gcntf(torch.nn.Module):
             a = v[1:] - v[:-1]  # (L-1) x N x 2
             a = torch.cat((state[1:2, ..., 4:6], a))  # L x N x 2
 
+            # Padded neighbors carry a 1e9 sentinel. Mask them explicitly and zero them, so that
+            # their features stay finite in reduced precision; masked entries never contribute.
+            valid = neighbor[..., :1] < 1e8  # (L+1) x N x Nn x 1
+            neighbor = neighbor.float().masked_fill(~valid, 0)
             neighbor_x = neighbor[..., :2]  # (L+1) x N x Nn x 2
             neighbor_v = neighbor[1:, ..., 2:4]  # L x N x Nn x 2
 
@@ -221,62 +249,35 @@ class gcntf(torch.nn.Module):
 
             # social features
             dist = dp.norm(dim=-1)  # (L+1) x N x Nn
-            mask = dist <= self.ob_radius
+            mask = (dist <= self.ob_radius) & valid.squeeze(-1)
             dp0, mask0 = dp[0], mask[0]
             dp, mask = dp[1:], mask[1:]
-            dist = dist[1:]
-            dot_dp_v = (dp @ v.unsqueeze(-1)).squeeze(-1)  # L x N x Nn
-            bearing = dot_dp_v / (dist * v.norm(dim=-1).unsqueeze(-1))  # L x N x Nn
-            bearing = bearing.nan_to_num(0, 0, 0)
-            dot_dp_dv = (dp.unsqueeze(-2) @ dv.unsqueeze(-1)).view(dp.size(0), N, Nn)
-            tau = -dot_dp_dv / dv.norm(dim=-1)  # L x N x Nn
-            tau = tau.nan_to_num(0, 0, 0).clip(0, 7)
-            mpd = (dp + tau.unsqueeze(-1) * dv).norm(dim=-1)  # L x N x Nn
-            features = torch.stack((dist, bearing, mpd), -1)  # L x N x Nn x 3
-
-        k = self.embed_k(features)  # L x N x Nn x d
+            features = self.social_features(dp, dv, v)  # L x N x Nn x 3
+
         s = self.embed_s(torch.cat((v, a), -1))
-        n = self.embed_n(torch.cat((dp, dv), -1))  # L x N x Nn x ...
+        if self.enc_mode == "packed":
+            # only neighbors within ob_radius are embedded, in fx_recurrence_packed
+            k, n = None, None
+        else:
+            k = self.embed_k(features[:L1])  # L1 x N x Nn x d
+            n = self.embed_n(torch.cat((dp, dv), -1))  # L x N x Nn x ...
 
         h = self.rnn_fx_init(dp0)  # N x Nn x d
         h = (mask0.unsqueeze(-1) * h).sum(-2)  # N x d
         h = h.view(N, -1, self.rnn_fx.num_layers)
         h = h.permute(2, 0, 1).contiguous()
 
-        trajectory_features = state
-        trajectory_features = self.feature_transform(trajectory_features)
-        batch_size, seq_len, feature_dim = trajectory_features.shape
-        trajectory_features = trajectory_features.transpose(0, 1)
-        attn_output, _ = self.self_attn(trajectory_features, trajectory_features, trajectory_features)
-        attn_output = attn_output.transpose(0, 1)
-
-
-        gcn_output = self.gcn_layer(attn_output, similarity)
-        self.gcn_outputs_queue.append(gcn_output)
-
-        if len(self.gcn_outputs_queue) == self.gcn_outputs_queue.maxlen:
-            spatio_temporal_features = torch.stack(list(self.gcn_outputs_queue), dim=2)
-            st_attn_input = spatio_temporal_features.view(-1, spatio_temporal_features.size(2), feature_dim)
-            st_attn_output, _ = self.st_attn(st_attn_input, st_attn_input, st_attn_input)
-            st_attn_output = st_attn_output.view(batch_size, seq_len, -1, feature_dim).mean(dim=2)
-            attn_output = attn_output.view(batch_size, seq_len, -1)
-            spatio_temporal_mean = spatio_temporal_features.mean(dim=2).view(batch_size, seq_len, -1)
-            combined_features = torch.cat((attn_output, spatio_temporal_mean, st_attn_output),dim=-1)
-            transformed_features = self.dim_reduction(combined_features)
-            combined_tensor = torch.cat([h, transformed_features], dim=0)
-            result_tensor = combined_tensor[0].unsqueeze(0)
-            h = result_tensor
-        for t in range(L1):
-            q = self.embed_q(h[-1])  # N x d
-            att = self.attention(q, k[t], mask[t])  # N x Nn
-            x_t = att.unsqueeze(-2) @ n[t]  # N x 1 x d
-            x_t = x_t.squeeze(-2)  # N x d
-            x_t = torch.cat((x_t, s[t]), -1).unsqueeze(0)
-            _, h = self.rnn_fx(x_t, h)
+        if n is None:
+            h = self.fx_recurrence_packed(h, features[:L1], torch.cat((dp[:L1], dv[:L1]), -1), s[:L1], mask[:L1])
+        else:
+            h = self.fx_recurrence(h, k, n[:L1], s[:L1], mask[:L1])
         x = h[-1]
         if y is None: return x
         mask_t = mask[L1:L1 + L2].unsqueeze(-1)  # L2 x N x Nn x 1
-        n_t = n[L1:L1 + L2]  # L2 x N x Nn x d
+        if n is None:
+            n_t = self.embed_n(torch.cat((dp[L1:L1 + L2], dv[L1:L1 + L2]), -1))  # L2 x N x Nn x d
+        else:
+            n_t = n[L1:L1 + L2]  # L2 x N x Nn x d
         n_t = (mask_t * n_t).sum(-2)  # L2 x N x d
         s_t = s[L1:L2 + L2]
         x_t = torch.cat((n_t, s_t), -1)
@@ -287,77 +288,124 @@ class gcntf(torch.nn.Module):
         b = torch.flip(b, (0,))
         return x, b
 
+    def quantize(self):
+        # a copy for CPU inference with dynamic int8 quantization of the heaviest layers:
+        # weights are stored in int8 and activations are quantized on the fly
+        # Quantized GRUs expose no weight tensors, so the broadcast first decoder step
+        # falls back to calling the module.
+        from torch.ao.quantization import quantize_dynamic
+        return quantize_dynamic(self.eval(), {"embed_k", "embed_q", "embed_n", "dec", "p_z", "rnn_fx", "rnn_fy"},
+                                dtype=torch.qint8)
+
     def forward(self, *args, **kwargs):
-        self.rnn_fx.flatten_parameters()
-        self.rnn_fy.flatten_parameters()
-        sim = []
         if self.training:
-            self.rnn_by.flatten_parameters()
             args = iter(args)
             x = kwargs["x"] if "x" in kwargs else next(args)
             y = kwargs["y"] if "y" in kwargs else next(args)
             neighbor = kwargs["neighbor"] if "neighbor" in kwargs else next(args)
-            similarity = kwargs["SIMILARITY"] if "SIMILARITY" in kwargs else next(args)
-            if similarity is None:
-                sim.append(0)
-            else:
-                sim.append(similarity)
-            return self.learn(x, y, neighbor, similarity=sim)
+            return self.learn(x, y, neighbor)
         args = iter(args)
         x = kwargs["x"] if "x" in kwargs else next(args)
-        neighbor = kwargs["neighbor"] if "neighbor" in kwargs else next(args)
-        try:
-            n_predictions = kwargs["n_predictions"] if "n_predictions" in kwargs else next(args)
-            similarity = kwargs["SIMILARITY"] if "SIMILARITY" in kwargs else next(args)
-        except:
-            n_predictions = 0
-            similarity = 0
-        stochastic = n_predictions > 0
+        neighbor = kwargs["neighbor"] if "neighbor" in kwargs else next(args, None)
+        n_predictions = kwargs["n_predictions"] if "n_predictions" in kwargs else next(args, 0)
+        C = x.dim()
+        if C < 3:
+            x = x.unsqueeze(1)
+            if neighbor is not None: neighbor = neighbor.unsqueeze(1)
+        pred = self.predict(x, neighbor, n_predictions)
+        if C < 3:
+            pred = pred.squeeze(-2)
+        return pred
+
+    def predict(self, x, neighbor=None, n_predictions: int = 0):
+        # inference entry point with explicit tensor arguments and no Python-side
+        # input handling, for torch.compile and torch.export
+        # x: L1 x N x 6, neighbor: L1 x N x Nn x 6
+        # returns positions, K x L2 x N x 2, or L2 x N x 2 for the mean prediction if n_predictions is 0
+        h = self.encode(x, neighbor)
+        return self.sample(h, n_predictions) + x[-1, ..., :2]
+
+    def encode(self, x, neighbor=None):
+        # x: L1 x N x 6, neighbor: L1 x N x Nn x 6
+        # returns the initial decoder state, n_layers x N x d, to be used with sample
         if neighbor is None:
             neighbor_shape = [_ for _ in x.shape]
             neighbor_shape.insert(-1, 0)
             neighbor = torch.empty(neighbor_shape, dtype=x.dtype, device=x.device)
-        C = x.dim()
-        if C < 3:
-            x = x.unsqueeze(1)
-            neighbor = neighbor.unsqueeze(1)
-            #if y is not None: y = y.unsqueeze(1)
         N = x.size(1)
         neighbor = neighbor[:x.size(0)]
 
-
-        h = self.enc(x, neighbor,similarity=similarity)
+        h = self.enc(x, neighbor)
         h = self.rnn_fy_init(h)
         h = h.view(N, -1, self.rnn_fy.num_layers)
-        h = h.permute(2, 0, 1)
-        if stochastic: h = h.repeat(1, n_predictions, 1)
-        h = h.contiguous()
+        return h.permute(2, 0, 1).contiguous()
+
+    def sample(self, h, n_predictions=0):
+        # h: n_layers x N x d from encode
+        # returns displacements from the last observed position, K x L2 x N x 2,
+        # or L2 x N x 2 for the mean prediction if n_predictions is 0
+        if n_predictions > 0:
+            # sample in chunks of whole sets of N agents, so that memory stays bounded for any K;
+            # in one go under graph capture, where the chunk size would pin the number of agents
+            if torch.compiler.is_compiling():
+                chunk = n_predictions
+            else:
+                chunk = max(1, self.decode_rows // h.size(1))
+            d = torch.cat([
+                self.decode_samples(h, min(chunk, n_predictions - k))
+                for k in range(0, n_predictions, chunk)
+            ])  # K x L2 x N x 2
+        else:
+            d = self.decode(h)  # L2 x N x 2
+        # accumulate positions in at least single precision under autocast
+        return torch.cumsum(d, -3, dtype=torch.promote_types(d.dtype, torch.float32))
+
+    def decode(self, h):
+        # h: n_layers x N x d
         D = []
         for t in range(self.horizon):
             p_z = self.p_z(h[-1])
-            if stochastic:
-                z = p_z.sample()
-            else:
-                z = p_z.mean
+            z = p_z.mean
             d = self.dec(z, h[-1])
             D.append(d)
             if t == self.horizon - 1: break
             zd = self.embed_zd(z, d)
-            h = h[:, :256, :]
-            h = h[:, :, :256]
             _, h = self.rnn_fy(zd.unsqueeze(0), h)
+        return torch.stack(D)  # L2 x N x 2
 
-        d = torch.stack(D)
-        pred = torch.cumsum(d, 0)
-        if stochastic:
-            new_n_predictions = pred.size(1)
-            pred = pred.view(pred.size(0), new_n_predictions, -1, pred.size(-1)).permute(1, 0, 2, 3)
-        pred = pred + x[-1, ..., :2]
-        if C < 3:
-            pred = pred.squeeze(1)
-        return pred
+    def decode_samples(self, h, n_samples):
+        # h: n_layers x N x d, shared by all samples until the first GRU step
+        K, N = n_samples, h.size(1)
+        rnn = self.rnn_fy
+        h0 = h[-1]  # N x d
+        D = []
+        for t in range(self.horizon):
+            if t == 0:
+                z = self.p_z(h0).sample((K,))  # K x N x z
+                d = self.dec(z, h0.expand(K, -1, -1))
+            else:
+                z = self.p_z(h[-1]).sample()
+                d = self.dec(z, h[-1])
+            D.append(d.view(K, N, -1))
+            if t == self.horizon - 1: break
+            zd = self.embed_zd(z, d).view(1, K * N, -1)
+            if t > 0:
+                _, h = rnn(zd, h)
+            elif isinstance(rnn, torch.nn.GRU) and rnn.num_layers == 1:
+                # GRU step with the hidden projection computed once per agent and broadcast over samples
+                gi = torch.nn.functional.linear(zd.view(K, N, -1), rnn.weight_ih_l0, rnn.bias_ih_l0)
+                gh = torch.nn.functional.linear(h0, rnn.weight_hh_l0, rnn.bias_hh_l0)
+                i_r, i_z, i_n = gi.chunk(3, -1)
+                h_r, h_z, h_n = gh.chunk(3, -1)
+                r = torch.sigmoid(i_r + h_r)
+                u = torch.sigmoid(i_z + h_z)
+                c = torch.tanh(i_n + r * h_n)
+                h = ((1 - u) * c + u * h0).view(1, K * N, -1)
+            else:
+                _, h = rnn(zd, h.repeat(1, K, 1))
+        return torch.stack(D, 1)  # K x L2 x N x 2
 
-    def learn(self, x, y, neighbor=None, similarity=None):
+    def learn(self, x, y, neighbor=None):
         C = x.dim()
         if C < 3:
             x = x.unsqueeze(1)
@@ -367,7 +415,7 @@ class gcntf(torch.nn.Module):
         if y.size(0) != self.horizon:
             print("[Warn] Unmatched sequence length in inference and generative model. ({} vs {})".format(y.size(0),
                                                                                                           self.horizon))
-        h, b = self.enc(x, neighbor, y=y, similarity=similarity)
+        h, b = self.enc(x, neighbor, y=y)
         h = self.rnn_fy_init(h)
         h = h.view(N, -1, self.rnn_fy.num_layers)
         h = h.permute(2, 0, 1).contiguous()
@@ -392,7 +440,7 @@ class gcntf(torch.nn.Module):
         d = torch.stack(D)
         with torch.no_grad():
             y = y - x[-1, ..., :2].unsqueeze(0)
-        pred = torch.cumsum(d, 0)
+        pred = torch.cumsum(d, 0, dtype=torch.promote_types(d.dtype, torch.float32))
 
         err = (pred - y).square()
         kl = []
@@ -5,7 +5,7 @@ import numpy as np
 # from torch.utils.tensorboard import SummaryWriter
 from gcntf import gcntf
 from data import Dataloader
-from utils import ADE_FDE, FPC, seed, get_rng_state, set_rng_state
+from utils import FPC_ADE_FDE, seed, get_rng_state, set_rng_state
 import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument("--train", nargs='+', default=[])
@@ -17,6 +17,15 @@ parser.add_argument("--device", type=str, default=None)
 parser.add_argument("--seed", type=int, default=1)
 parser.add_argument("--no-fpc", action="store_true", default=False)
 parser.add_argument("--fpc-finetune", action="store_true", default=False)
+parser.add_argument("--cache", type=str, default=None)
+parser.add_argument("--prune-neighbors", action="store_true", default=False)
+parser.add_argument("--prune-radius", type=float, default=None)
+parser.add_argument("--bucket", action="store_true", default=False)
+parser.add_argument("--workers", type=int, default=0)
+parser.add_argument("--quantize", action="store_true", default=False)
+parser.add_argument("--amp", type=str, default=None, choices=["bf16", "fp16"])
+parser.add_argument("--dist-backend", type=str, default=None, choices=["gloo", "nccl"])
+parser.add_argument("--enc-mode", type=str, default="loop", choices=["loop", "packed"])
 
 if __name__ == "__main__":
     settings = parser.parse_args()
@@ -27,14 +36,40 @@ if __name__ == "__main__":
     if settings.device is None:
         settings.device = "cuda" if torch.cuda.is_available() else "cpu"
     settings.device = torch.device(settings.device)
-    seed(settings.seed)
+    # data-parallel training and evaluation when started by torchrun, e.g.
+    #   torchrun --nproc-per-node 4 main.py --train ... --config ...
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    distributed = world_size > 1
+    if distributed:
+        if config.BATCH_SIZE % world_size:
+            parser.error("BATCH_SIZE {} is not divisible by {} processes".format(config.BATCH_SIZE, world_size))
+        if settings.device.type == "cuda":
+            settings.device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+            torch.cuda.set_device(settings.device)
+        if settings.dist_backend is None:
+            settings.dist_backend = "nccl" if settings.device.type == "cuda" else "gloo"
+        torch.distributed.init_process_group(settings.dist_backend)
+        if rank > 0: sys.stdout = open(os.devnull, "w")
+    if settings.quantize and (settings.train or settings.device.type != "cpu"):
+        parser.error("--quantize is for inference on the CPU, without --train")
+    seed(settings.seed + rank)
     init_rng_state = get_rng_state(settings.device)
+    amp_dtype = dict(bf16=torch.bfloat16, fp16=torch.float16).get(settings.amp)
+    autocast = lambda: torch.autocast(settings.device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
     rng_state = init_rng_state
 
+    if settings.prune_neighbors and settings.prune_radius is None:
+        settings.prune_radius = config.OB_RADIUS
     kwargs = dict(
             batch_first=False, frameskip=settings.frameskip,
             ob_horizon=config.OB_HORIZON, pred_horizon=config.PRED_HORIZON,
-            device=settings.device, seed=settings.seed)
+            device=settings.device, seed=settings.seed, cache_dir=settings.cache,
+            neighbor_radius=settings.prune_radius if settings.prune_neighbors else None,
+            cpu_collate=settings.workers > 0, num_replicas=world_size, rank=rank)
+    loader_kwargs = dict(
+            num_workers=settings.workers, pin_memory=settings.workers > 0 and settings.device.type == "cuda",
+            worker_init_fn=Dataloader.worker_init_fn if settings.workers > 0 else None)
     train_data, test_data = None, None
     if settings.test:
         print(settings.test)
@@ -44,62 +79,71 @@ if __name__ == "__main__":
             inclusive = None
         test_dataset = Dataloader(
             settings.test, **kwargs, inclusive_groups=inclusive,
-            batch_size=config.BATCH_SIZE, shuffle=False
+            batch_size=config.BATCH_SIZE // world_size, shuffle=False, drop_last=False
         )
         test_data = torch.utils.data.DataLoader(test_dataset,
             collate_fn=test_dataset.collate_fn,
-            batch_sampler=test_dataset.batch_sampler
+            batch_sampler=test_dataset.batch_sampler, **loader_kwargs
         )
+        # per-sample scale to world units; WORLD_SCALE may also give one value per scene
+        world_scale = test_dataset.world_scale(config.WORLD_SCALE)
+        world_scale = None if np.all(world_scale == 1) else torch.as_tensor(world_scale, device=settings.device)
         def test(model, fpc=1):
+            # fpc may be a sequence of values, evaluated on one shared pool of predictions
+            fpc_range = [int(f) if f else 1 for f in (fpc if np.iterable(fpc) else [fpc])]
             sys.stdout.write("\r\033[K Evaluating...{}/{}".format(
                 0, len(test_dataset)
             ))
             tic = time.time()
             model.eval()
-            ADE, FDE = [], []
+            ADE, FDE = {f: [] for f in fpc_range}, {f: [] for f in fpc_range}
             set_rng_state(init_rng_state, settings.device)
             batch = 0
-            fpc = int(fpc) if fpc else 1
-            fpc_config = "FPC: {}".format(fpc) if fpc > 1 else "w/o FPC"
+            fpc_config = lambda f: "FPC: {}".format(f) if f > 1 else "w/o FPC"
             with torch.no_grad():
-                for x, y, neighbor, *_ in test_data:
+                for item in test_data:
+                    x, y, neighbor = test_dataset.to_device(item)
                     batch += x.size(1)
                     sys.stdout.write("\r\033[K Evaluating...{}/{} ({}) -- time: {}s".format(
-                        batch, len(test_dataset), fpc_config, int(time.time()-tic)
+                        batch, len(test_dataset), ", ".join(map(fpc_config, fpc_range)), int(time.time()-tic)
                     ))
 
-                    if config.PRED_SAMPLES > 0 and fpc > 1:
-                        y_ = []
-                        for _ in range(fpc):
-                            y_.append(model(x, neighbor, n_predictions=config.PRED_SAMPLES))
-                        y_ = torch.cat(y_, 0)
-                        cand = []
-                        for i in range(y_.size(-2)):
-                            cand.append(FPC(y_[..., i, :].cpu().numpy(), n_samples=config.PRED_SAMPLES))
-                        y_ = torch.stack([y_[_,:,i] for i, _ in enumerate(cand)], 2)
-                    else:
-                        y_ = model(x, neighbor, n_predictions=config.PRED_SAMPLES)
-                    ade, fde = ADE_FDE(y_, y)
-                    if config.PRED_SAMPLES > 0:
-                        ade = torch.min(ade, dim=0)[0]
-                        fde = torch.min(fde, dim=0)[0]
-                    ADE.append(ade)
-                    FDE.append(fde)
-            ADE = torch.cat(ADE)
-            FDE = torch.cat(FDE)
-            if torch.is_tensor(config.WORLD_SCALE) or config.WORLD_SCALE != 1:
-                if not torch.is_tensor(config.WORLD_SCALE):
-                    config.WORLD_SCALE = torch.as_tensor(config.WORLD_SCALE, device=ADE.device, dtype=ADE.dtype)
-                ADE *= config.WORLD_SCALE
-                FDE *= config.WORLD_SCALE
-            ade = ADE.mean()
-            fde = FDE.mean()
-            sys.stdout.write("\r\033[K ADE: {:.4f}; FDE: {:.4f} ({}) -- time: {}s".format(
-                ade, fde, fpc_config,
-                int(time.time()-tic))
-            )
-            print()
-            return ade, fde
+                    with autocast():
+                        h = model.encode(x, neighbor)
+                        # candidates for the largest fpc; smaller values cluster a prefix of them
+                        n_samples = config.PRED_SAMPLES * max(fpc_range)
+                        pool = model.sample(h, n_samples) + x[-1, ..., :2]
+                    for f in fpc_range:
+                        ade, fde = FPC_ADE_FDE(pool, y, config.PRED_SAMPLES, f)
+                        ADE[f].append(ade)
+                        FDE[f].append(fde)
+            ade_, fde_ = [], []
+            for f in fpc_range:
+                ade = torch.cat(ADE[f])
+                fde = torch.cat(FDE[f])
+                if world_scale is not None:
+                    scale = world_scale
+                    if distributed:
+                        # the scales of this process's shard, in the order it evaluated them
+                        scale = scale[rank::world_size][:ade.size(0)]
+                    ade *= scale.to(ade.dtype)
+                    fde *= scale.to(fde.dtype)
+                if distributed:
+                    # means over the samples of all processes
+                    stats = torch.stack((ade.sum(), fde.sum(), ade.new_tensor(ade.size(0))))
+                    torch.distributed.all_reduce(stats)
+                    ade_.append(stats[0] / stats[2])
+                    fde_.append(stats[1] / stats[2])
+                else:
+                    ade_.append(ade.mean())
+                    fde_.append(fde.mean())
+                sys.stdout.write("\r\033[K ADE: {:.4f}; FDE: {:.4f} ({}) -- time: {}s".format(
+                    ade_[-1], fde_[-1], fpc_config(f),
+                    int(time.time()-tic))
+                )
+                print()
+            if np.iterable(fpc): return ade_, fde_
+            return ade_[0], fde_[0]
 
     if settings.train:
         print(settings.train)
@@ -110,24 +154,28 @@ if __name__ == "__main__":
         train_dataset = Dataloader(
             settings.train, **kwargs, inclusive_groups=inclusive,
             flip=True, rotate=True, scale=True,
-            batch_size=config.BATCH_SIZE, shuffle=True, batches_per_epoch=config.EPOCH_BATCHES
+            batch_size=config.BATCH_SIZE // world_size, shuffle=True, batches_per_epoch=config.EPOCH_BATCHES,
+            bucket=settings.bucket
         )
         train_data = torch.utils.data.DataLoader(train_dataset,
             collate_fn=train_dataset.collate_fn,
-            batch_sampler=train_dataset.batch_sampler
+            batch_sampler=train_dataset.batch_sampler, **loader_kwargs
         )
         batches = train_dataset.batches_per_epoch
 
 
-    model = gcntf(horizon=config.PRED_HORIZON, ob_radius=config.OB_RADIUS, hidden_dim=config.RNN_HIDDEN_DIM)
+    model = gcntf(horizon=config.PRED_HORIZON, ob_radius=config.OB_RADIUS, hidden_dim=config.RNN_HIDDEN_DIM,
+                  enc_mode=settings.enc_mode)
     model.to(settings.device)
     optimizer = torch.optim.Adam(model.parameters(), lr=config.LEARNING_RATE)
+    # loss scaling against fp16 gradient underflow; bf16 has the range of fp32
+    scaler = torch.amp.GradScaler(settings.device.type, enabled=amp_dtype == torch.float16)
     start_epoch = 0
     if settings.ckpt:
         ckpt = os.path.join(settings.ckpt, "ckpt-last")
         ckpt_best = os.path.join(settings.ckpt, "ckpt-best")
         if os.path.exists(ckpt_best):
-            state_dict = torch.load(ckpt_best, map_location=settings.device)
+            state_dict = torch.load(ckpt_best, map_location=settings.device, weights_only=False)
             ade_best = state_dict["ade"]
             fde_best = state_dict["fde"]
             fpc_best = state_dict["fpc"] if "fpc" in state_dict else 1
@@ -139,13 +187,26 @@ if __name__ == "__main__":
             ckpt = ckpt_best
         if os.path.exists(ckpt):
             print("Load from ckpt:", ckpt)
-            state_dict = torch.load(ckpt, map_location=settings.device)
+            state_dict = torch.load(ckpt, map_location=settings.device, weights_only=False)
             model.load_state_dict(state_dict["model"])
             if "optimizer" in state_dict:
                 optimizer.load_state_dict(state_dict["optimizer"])
-                rng_state = [r.to("cpu") if torch.is_tensor(r) else r for r in state_dict["rng_state"]]
+                # one state per rank; checkpoints before that hold a single state, the one of rank 0
+                rng_states = state_dict["rng_state"]
+                if isinstance(rng_states, tuple): rng_states = [rng_states]
+                if rank < len(rng_states):
+                    rng_state = [r.to("cpu") if torch.is_tensor(r) else r for r in rng_states[rank]]
+                else:
+                    print("No rng state saved for rank {}; starting from its seed".format(rank))
             start_epoch = state_dict["epoch"]
     end_epoch = start_epoch+1 if train_data is None or start_epoch >= config.EPOCHS else config.EPOCHS
+    if settings.quantize:
+        model = model.quantize()
+    train_model = model
+    if distributed and train_data is not None:
+        # the parameters kept only for loading old checkpoints take no part in the loss
+        train_model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True,
+            device_ids=[settings.device.index] if settings.device.type == "cuda" else None)
 
     # if settings.train and settings.ckpt:
     #     logger = SummaryWriter(log_dir=settings.ckpt)
@@ -169,10 +230,13 @@ if __name__ == "__main__":
                 cur_batch=0, done="", remain="."*int(batches*progress),
                 time=round(time.time()-tic), comment=""))
             for batch, item in enumerate(train_data):
-                res = model(*item)
-                loss = model.loss(*res)
-                loss["loss"].backward()
-                optimizer.step()
+                item = train_dataset.to_device(item)
+                with autocast():
+                    res = train_model(*item)
+                    loss = model.loss(*res)
+                scaler.scale(loss["loss"]).backward()
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad()
                 for k, v in loss.items():
                     if k not in losses:
@@ -186,6 +250,8 @@ if __name__ == "__main__":
                     comment=" - ".join(["{}: {:.4f}".format(k, v) for k, v in losses.items()])
                 ))
             rng_state = get_rng_state(settings.device)
+            if settings.bucket:
+                sys.stdout.write(" - padding: {:.1%}".format(train_dataset.batch_sampler.padding_ratio()))
             print()
 
         ade, fde = 9999, 9999
@@ -197,20 +263,26 @@ if __name__ == "__main__":
                 fpc = 1
             ade, fde = test(model, fpc)
 
-        # if losses is not None and settings.ckpt:
-        #     if logger is not None:
-        #         for k, v in losses.items():
-        #             logger.add_scalar("train/{}".format(k), v, epoch)
-        #         if perform_test:
-        #             logger.add_scalar("eval/ADE", ade, epoch)
-        #             logger.add_scalar("eval/FDE", fde, epoch)
+        if losses is not None and settings.ckpt:
+            rng_states = [rng_state]
+            if distributed:
+                rng_states = [None]*world_size
+                torch.distributed.all_gather_object(rng_states, rng_state)
+        if losses is not None and settings.ckpt and rank == 0:
+            # if logger is not None:
+            #     for k, v in losses.items():
+            #         logger.add_scalar("train/{}".format(k), v, epoch)
+            #     if perform_test:
+            #         logger.add_scalar("eval/ADE", ade, epoch)
+            #         logger.add_scalar("eval/FDE", fde, epoch)
             state = dict(
                 model=model.state_dict(),
                 optimizer=optimizer.state_dict(),
-                ade=ade, fde=fde, epoch=epoch, rng_state=rng_state
+                ade=ade, fde=fde, epoch=epoch, rng_state=rng_states
             )
             torch.save(state, ckpt)
-            if ade < ade_best:
+            # epochs before TEST_SINCE keep the placeholder ade and are never best
+            if perform_test and ade < ade_best:
                 ade_best = ade
                 fde_best = fde
                 state = dict(
@@ -222,18 +294,16 @@ if __name__ == "__main__":
     if settings.fpc_finetune or losses is not None:
         precision = 2
         trunc = lambda v: np.trunc(v*10**precision)/10**precision
-        ade_, fde_, fpc_ = [], [], []
-        for fpc in config.FPC_SEARCH_RANGE:
-            ade, fde = test(model, fpc)
-            ade_.append(trunc(ade.item()))
-            fde_.append(trunc(fde.item()))
-            fpc_.append(fpc)
+        fpc_ = list(config.FPC_SEARCH_RANGE)
+        ade_, fde_ = test(model, fpc_)
+        ade_ = [trunc(ade.item()) for ade in ade_]
+        fde_ = [trunc(fde.item()) for fde in fde_]
         i = np.argmin(np.add(ade_, fde_))
         ade, fde, fpc = ade_[i], fde_[i], fpc_[i]
-        if settings.ckpt:
+        if settings.ckpt and rank == 0:
             ckpt_best = os.path.join(settings.ckpt, "ckpt-best")
             if os.path.exists(ckpt_best):
-                state_dict = torch.load(ckpt_best, map_location=settings.device)
+                state_dict = torch.load(ckpt_best, map_location=settings.device, weights_only=False)
                 state_dict["ade_fpc"] = ade
                 state_dict["fde_fpc"] = fde
                 state_dict["fpc"] = fpc
@@ -241,3 +311,5 @@ if __name__ == "__main__":
         print(" ADE: {:.2f}; FDE: {:.2f} ({})".format(
             ade, fde, "FPC: {}".format(fpc) if fpc > 1 else "w/o FPC",
         ))
+    if distributed:
+        torch.distributed.destroy_process_group()
@@ -0,0 +1,295 @@
+import os, sys, time
+import json
+import asyncio
+import argparse
+import importlib
+import collections
+import concurrent.futures
+import numpy as np
+import torch
+from gcntf import gcntf
+from utils import select_FPC
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config", type=str, default=None)
+parser.add_argument("--ckpt", type=str, default=None)
+parser.add_argument("--device", type=str, default=None)
+parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--max-delay", type=float, default=5, help="batching window in ms")
+parser.add_argument("--max-agents", type=int, default=1024)
+parser.add_argument("--fpc", type=int, default=None)
+parser.add_argument("--quantize", action="store_true", default=False)
+parser.add_argument("--enc-mode", type=str, default="packed", choices=["loop", "packed"])
+
+
+class BatchingServer(object):
+    # Serves model predictions to concurrent requests. Requests arriving within max_delay
+    # of the first waiting one are concatenated along the agent axis, with neighbors padded
+    # by the 1e9 sentinel, and run in one pass; every request gets its own agents back.
+    # The model only ever runs on one worker thread, one batch at a time.
+
+    def __init__(self, model, ob_horizon, n_samples=20, fpc=1, max_delay=0.005, max_agents=1024, device=None):
+        self.model = model.eval()
+        self.ob_horizon = ob_horizon
+        self.n_samples = n_samples
+        self.fpc = fpc
+        self.max_delay = max_delay
+        self.max_agents = max_agents
+        self.device = device or next(model.parameters()).device
+        self.queue = None
+        self.carry = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.latency = collections.deque(maxlen=10000)
+        self.batch_requests = collections.Counter()
+        self.batch_agents = collections.Counter()
+        self.n_requests = 0
+        self.n_batches = 0
+
+    def metrics(self):
+        # request latencies in ms over the last 10000 requests; batch sizes in power-of-two buckets
+        latency = np.array(self.latency) * 1000
+        bucket = lambda counter: {str(k): counter[k] for k in sorted(counter)}
+        return dict(
+            queue_depth=(self.queue.qsize() if self.queue is not None else 0) + (self.carry is not None),
+            requests=self.n_requests, batches=self.n_batches,
+            batch_requests=bucket(self.batch_requests), batch_agents=bucket(self.batch_agents),
+            latency_p50=float(np.percentile(latency, 50)) if len(latency) else None,
+            latency_p99=float(np.percentile(latency, 99)) if len(latency) else None
+        )
+
+    async def predict(self, x, neighbor):
+        # x: L1 x N x 6, neighbor: L1 x N x Nn x 6
+        # returns K x L2 x N x 2 predicted positions, or L2 x N x 2 if n_samples is 0
+        if x.dim() != 3 or x.size(0) != self.ob_horizon or x.size(-1) != 6:
+            raise ValueError("x must be {} x N x 6, got {}".format(self.ob_horizon, tuple(x.shape)))
+        if neighbor.dim() != 4 or neighbor.shape[:2] != x.shape[:2] or neighbor.size(-1) != 6:
+            raise ValueError("neighbor must be {} x {} x Nn x 6, got {}".format(
+                self.ob_horizon, x.size(1), tuple(neighbor.shape)))
+        if x.size(1) > self.max_agents:
+            raise ValueError("At most {} agents per request, got {}".format(self.max_agents, x.size(1)))
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.ensure_future(self.batch_loop())
+        future = asyncio.get_running_loop().create_future()
+        tic = time.perf_counter()
+        await self.queue.put((x, neighbor, future))
+        pred = await future
+        self.latency.append(time.perf_counter() - tic)
+        self.n_requests += 1
+        return pred
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.carry is None:
+                batch = [await self.queue.get()]
+            else:
+                batch, self.carry = [self.carry], None
+            n_agents = batch[0][0].size(1)
+            deadline = loop.time() + self.max_delay
+            while n_agents < self.max_agents:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if n_agents + item[0].size(1) > self.max_agents:
+                    # first in the next batch
+                    self.carry = item
+                    break
+                batch.append(item)
+                n_agents += item[0].size(1)
+            batch = [item for item in batch if not item[-1].cancelled()]
+            if not batch: continue
+            self.n_batches += 1
+            self.batch_requests[1 << (len(batch) - 1).bit_length()] += 1
+            self.batch_agents[1 << (n_agents - 1).bit_length()] += 1
+            try:
+                pred = await loop.run_in_executor(self.executor, self.run_batch, [item[:2] for item in batch])
+            except Exception as e:
+                # rerun the requests one by one, so that only the failing ones get the error
+                pred = [e] if len(batch) == 1 else await self.run_each(batch)
+            for (*_, future), p in zip(batch, pred):
+                if future.done(): continue
+                if isinstance(p, Exception):
+                    future.set_exception(p)
+                else:
+                    future.set_result(p)
+
+    async def run_each(self, batch):
+        # returns the prediction, or the exception raised, for each request in the batch
+        loop = asyncio.get_running_loop()
+        res = []
+        for item in batch:
+            try:
+                res.extend(await loop.run_in_executor(self.executor, self.run_batch, [item[:2]]))
+            except Exception as e:
+                res.append(e)
+        return res
+
+    def run_batch(self, requests):
+        # one forward pass over the requests, concatenated along the agent axis
+        counts = [x.size(1) for x, _ in requests]
+        Nn = max(neighbor.size(2) for _, neighbor in requests)
+        x = torch.cat([x for x, _ in requests], 1).to(self.device)
+        neighbor = torch.cat([
+            torch.nn.functional.pad(neighbor, (0, 0, 0, Nn - neighbor.size(2)), value=1e9)
+            for _, neighbor in requests
+        ], 1).to(self.device)
+        with torch.no_grad():
+            pool = self.model.predict(x, neighbor, self.n_samples * max(1, self.fpc))
+            pred = select_FPC(pool, self.n_samples, self.fpc)
+        return pred.cpu().split(counts, -2)
+
+    STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+    @staticmethod
+    async def read_request(reader):
+        # returns method, path, headers and body, or None at the end of the stream;
+        # raises ValueError on a malformed request line or header
+        line = await reader.readline()
+        if not line: return None
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line: break
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length < 0: raise ValueError("Negative Content-Length")
+        return method, path, headers, await reader.readexactly(length)
+
+    async def respond(self, writer, status, res):
+        payload = json.dumps(res).encode()
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+            status, self.STATUS[status], len(payload)
+        ).encode() + payload)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive:
+        #   POST /predict {"x": L1 x N x 6, "neighbor": L1 x N x Nn x 6} -> {"pred": K x L2 x N x 2}
+        #   GET /metrics
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except ValueError as e:
+                    # the rest of the stream cannot be framed; answer and close
+                    await self.respond(writer, 400, dict(error="Malformed request: {}".format(e)))
+                    break
+                if request is None: break
+                method, path, headers, body = request
+                status, res = 200, None
+                try:
+                    if method == "GET" and path == "/metrics":
+                        res = self.metrics()
+                    elif method == "POST" and path == "/predict":
+                        req = json.loads(body)
+                        x = torch.tensor(req["x"], dtype=torch.float32)
+                        neighbor = req.get("neighbor")
+                        if neighbor is None or not np.size(neighbor):
+                            neighbor = torch.empty(x.shape[:2] + (0, 6))
+                        else:
+                            neighbor = torch.tensor(neighbor, dtype=torch.float32)
+                        res = dict(pred=(await self.predict(x, neighbor)).tolist())
+                    else:
+                        status, res = 404, dict(error="Not found: {} {}".format(method, path))
+                except (ValueError, KeyError, TypeError) as e:
+                    status, res = 400, dict(error=str(e))
+                except Exception as e:
+                    status, res = 500, dict(error="{}: {}".format(type(e).__name__, e))
+                await self.respond(writer, status, res)
+                if headers.get("connection", "").lower() == "close": break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        # returns the listening asyncio server; port 0 picks a free port
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve(self, host, port):
+        server = await self.start(host, port)
+        print(" Serving on http://{}:{}".format(host, port))
+        async with server:
+            await server.serve_forever()
+
+
+class Client(object):
+    # a keep-alive client for the server, for local testing and load generation
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader, self.writer = None, None
+
+    async def request(self, method, path, payload=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(
+            method, path, self.host, len(body)).encode() + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").strip()
+            if not line: break
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        res = json.loads(await self.reader.readexactly(int(headers["content-length"])))
+        if status != 200:
+            raise RuntimeError("{} {}: {}".format(status, path, res.get("error")))
+        return res
+
+    async def predict(self, x, neighbor):
+        return torch.tensor((await self.request("POST", "/predict", dict(
+            x=x.tolist(), neighbor=neighbor.tolist())))["pred"])
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader, self.writer = None, None
+
+
+if __name__ == "__main__":
+    settings = parser.parse_args()
+    spec = importlib.util.spec_from_file_location("config", settings.config)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    if settings.device is None:
+        settings.device = "cuda" if torch.cuda.is_available() else "cpu"
+    settings.device = torch.device(settings.device)
+    if settings.quantize and settings.device.type != "cpu":
+        parser.error("--quantize is for inference on the CPU")
+
+    model = gcntf(horizon=config.PRED_HORIZON, ob_radius=config.OB_RADIUS, hidden_dim=config.RNN_HIDDEN_DIM,
+                  enc_mode=settings.enc_mode)
+    fpc = 1
+    if settings.ckpt:
+        ckpt = settings.ckpt
+        if os.path.isdir(ckpt):
+            ckpt = os.path.join(ckpt, "ckpt-best")
+        print("Load from ckpt:", ckpt)
+        state_dict = torch.load(ckpt, map_location=settings.device)
+        model.load_state_dict(state_dict["model"])
+        if "fpc" in state_dict: fpc = int(state_dict["fpc"])
+    if settings.fpc is not None:
+        fpc = settings.fpc
+    model.to(settings.device).eval()
+    if settings.quantize:
+        model = model.quantize()
+
+    server = BatchingServer(model, config.OB_HORIZON, n_samples=config.PRED_SAMPLES, fpc=fpc,
+                            max_delay=settings.max_delay / 1000, max_agents=settings.max_agents,
+                            device=settings.device)
+    try:
+        asyncio.run(server.serve(settings.host, settings.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,97 @@
+import numpy as np
+import torch
+
+
+class StreamingPredictor(object):
+    # Online prediction from tracker output, one frame at a time. Each new frame advances
+    # the rnn_fx state of every tracked agent by one encoder step; a new agent starts from
+    # its neighbors, as at the first frame of an observation window. After ob_horizon
+    # frames the state equals the full encoder's; longer tracks keep running the recurrence.
+    # Velocities and accelerations are backward differences as in Dataloader.extend, zero
+    # at the first frame of a track. Frames must come at the model's frame rate; an agent
+    # missing from a frame is dropped and starts a new track when it reappears.
+
+    def __init__(self, model, device=None):
+        self.model = model.eval()
+        self.device = device or next(model.parameters()).device
+        self.reset()
+
+    def reset(self):
+        d = self.model.rnn_fx.hidden_size
+        n_layers = self.model.rnn_fx.num_layers
+        self.ids = np.empty(0, dtype=np.int64)
+        self.p = torch.empty(0, 2, device=self.device)  # N x 2
+        self.v = torch.empty(0, 2, device=self.device)  # N x 2
+        self.has_v = torch.empty(0, dtype=torch.bool, device=self.device)  # N
+        self.h = torch.empty(n_layers, 0, d, device=self.device)  # n_layers x N x d
+        self.frames = np.empty(0, dtype=np.int64)  # frames observed per agent
+
+    def update(self, ids, xy):
+        # ids: N agent ids, xy: N x 2 positions of the agents observed in the new frame
+        model = self.model
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(np.unique(ids)) != len(ids):
+            raise ValueError("Duplicate agent ids in a frame")
+        p = torch.as_tensor(xy, dtype=torch.float32, device=self.device).view(-1, 2)
+        N = len(ids)
+
+        # continue the tracks of the agents seen in the previous frame
+        slot = {aid: i for i, aid in enumerate(self.ids)}
+        prev = np.array([slot.get(aid, -1) for aid in ids], dtype=np.int64)
+        cont = prev >= 0
+        i_cont = torch.as_tensor(np.flatnonzero(cont), device=self.device)
+        i_new = torch.as_tensor(np.flatnonzero(~cont), device=self.device)
+        prev = torch.as_tensor(prev[cont], device=self.device)
+
+        v = torch.zeros_like(p)
+        v[i_cont] = p[i_cont] - self.p[prev]
+        a = torch.zeros_like(p)
+        has_a = self.has_v[prev]
+        a[i_cont[has_a]] = v[i_cont[has_a]] - self.v[prev[has_a]]
+
+        with torch.no_grad():
+            # neighbors within ob_radius, in packed layout: pair k is agent i[k] and neighbor j[k]
+            dp = p.unsqueeze(0) - p.unsqueeze(1)  # N x N x 2
+            in_range = dp.norm(dim=-1) <= model.ob_radius
+            in_range.fill_diagonal_(False)
+
+            h = self.h.new_empty(self.h.size(0), N, self.h.size(-1))
+            if len(i_new):
+                # initial state, as from the first frame of an observation window
+                i, j = in_range[i_new].nonzero(as_tuple=True)
+                h0 = model.rnn_fx_init(dp[i_new][i, j])  # P x n_layers*d
+                h0 = h0.new_zeros(len(i_new), h0.size(-1)).index_add(0, i, h0)
+                h[:, i_new] = h0.view(len(i_new), -1, h.size(0)).permute(2, 0, 1)
+            if len(i_cont):
+                # one encoder step, as in gcntf.fx_recurrence_packed
+                i, j = in_range[i_cont].nonzero(as_tuple=True)
+                dp_t = dp[i_cont][i, j]  # P x 2
+                dv_t = v[j] - v[i_cont][i]  # P x 2
+                features = model.social_features(dp_t.unsqueeze(-2), dv_t.unsqueeze(-2), v[i_cont][i])
+                k = model.embed_k(features.squeeze(-2))  # P x d
+                n = model.embed_n(torch.cat((dp_t, dv_t), -1))  # P x d
+                s = model.embed_s(torch.cat((v[i_cont], a[i_cont]), -1))  # N x d
+                h_t = self.h[:, prev]
+                q = model.embed_q(h_t[-1])  # N x d
+                att = model.attention_packed(q, k, i)  # P
+                x_t = q.new_zeros(q.size(0), n.size(-1)).index_add(0, i, att.unsqueeze(-1) * n)
+                x_t = torch.cat((x_t, s), -1).unsqueeze(0)
+                _, h[:, i_cont] = model.rnn_fx(x_t, h_t.contiguous())
+
+        frames = np.ones(N, dtype=np.int64)
+        frames[cont] += self.frames[prev.cpu().numpy()]
+        self.ids, self.p, self.v, self.h, self.frames = ids, p, v, h, frames
+        self.has_v = torch.as_tensor(cont, device=self.device)
+
+    def predict(self, n_samples=0, min_frames=1):
+        # forecasts of the agents in the last frame observed for at least min_frames frames
+        # returns their ids and positions, K x L2 x N x 2, or L2 x N x 2 for the mean if n_samples is 0
+        model = self.model
+        idx = torch.as_tensor(np.flatnonzero(self.frames >= min_frames), device=self.device)
+        h = self.h[-1, idx]  # N x d
+        with torch.no_grad():
+            h = model.rnn_fy_init(h)
+            h = h.view(h.size(0), model.rnn_fy.hidden_size, model.rnn_fy.num_layers)
+            h = h.permute(2, 0, 1).contiguous()
+            pred = model.sample(h, n_samples) + self.p[idx]
+        return self.ids[idx.cpu().numpy()], pred
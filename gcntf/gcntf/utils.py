@@ -42,6 +42,98 @@ def FPC(y, n_samples):
     dist = np.linalg.norm(goal_[:,np.newaxis,:2] - goal[np.newaxis,:,:2], axis=-1)
     chosen = np.argmin(dist, axis=1)
     return chosen
+def batch_kmeans(k, data, iters=None, tol=0.0001):
+    # k-means of every row of data (N x M x D) at once, with k-means++ seeding
+    N, M, _ = data.shape
+    rows = torch.arange(N, device=data.device)
+    centroids = [data[rows, torch.randint(M, (N,), device=data.device)]]
+    d2 = (data - centroids[0].unsqueeze(1)).square().sum(-1)  # N x M
+    for _ in range(1, k):
+        # draw with probability proportional to d2; uniformly if all points coincide with centroids
+        cdf = torch.where(d2.sum(-1, keepdim=True) > 0, d2, torch.ones_like(d2)).cumsum(-1)
+        pick = torch.searchsorted(cdf, torch.rand(N, 1, device=data.device, dtype=cdf.dtype) * cdf[:, -1:])
+        centroids.append(data[rows, pick.squeeze(-1).clamp(max=M - 1)])
+        d2 = torch.minimum(d2, (data - centroids[-1].unsqueeze(1)).square().sum(-1))
+    centroids = torch.stack(centroids, 1)  # N x k x D
+
+    if iters is None: iters = 300
+    # Iterate on a working set of agents that is gathered from data again only once half of it
+    # has converged; converged agents in it keep their centroids.
+    idx = rows
+    c = centroids
+    xt = data.transpose(1, 2).contiguous()  # N x D x M
+    # the extra column of ones counts the points of each cluster in the same bmm as their sum
+    x1 = torch.cat((data, torch.ones_like(data[..., :1])), -1)  # N x M x (D+1)
+    labels = torch.arange(k, device=data.device, dtype=data.dtype).view(1, 1, k)
+    # the n x k x M intermediates are written into buffers allocated once; fresh allocations
+    # of this size cost more than the arithmetic on the CPU
+    distances_, onehot_ = data.new_empty(N, k, M), data.new_empty(N, k, M)
+    moving = torch.ones(N, dtype=torch.bool, device=data.device)
+    # assignments of the last two iterations; an agent stops once they repeat,
+    # which also catches the 2-cycles that float32 near-ties cause
+    assign = torch.full((N, 2, M), -1, dtype=data.dtype, device=data.device)
+    for _ in range(iters):
+        n = len(idx)
+        # squared distances up to the |x|^2 term, which does not change the nearest centroid;
+        # centroids along dim 1, so that the minimum is an elementwise reduction over k slices
+        distances = torch.baddbmm(c.square().sum(-1).unsqueeze(-1), c, xt, alpha=-2,
+                                  out=distances_[:n])  # n x k x M
+        onehot = torch.sub(distances.amin(1, keepdim=True), distances, out=onehot_[:n]).ge_(0)  # 1 at the nearest
+        c_ = torch.bmm(onehot, x1)  # n x k x (D+1)
+        if (c_[..., -1].sum(-1) != M).any():
+            # points exactly as near to two centroids go to the first of them
+            i, j = (onehot.sum(1) > 1).nonzero(as_tuple=True)
+            onehot[i, :, j] = torch.nn.functional.one_hot(onehot[i, :, j].argmax(-1), k).to(onehot.dtype)
+            c_ = torch.bmm(onehot, x1)
+        closest = torch.bmm(labels.expand(n, -1, -1), onehot).squeeze(1)  # n x M
+        count = c_[..., -1:]  # n x k x 1
+        c_ = c_[..., :-1] / count.clamp(min=1)
+        empty = count == 0
+        if empty.any():
+            # an empty cluster restarts from a random point
+            restart = x1[torch.arange(n, device=data.device).unsqueeze(-1),
+                         torch.randint(M, (n, k), device=data.device), :-1]
+            c_ = torch.where(empty, restart, c_)
+        repeat = (closest.unsqueeze(1) == assign).all(-1).any(-1) & ~empty.flatten(1).any(-1)
+        assign = torch.stack((closest, assign[:, 0]), 1)
+        moved = (c_ - c).flatten(1).norm(dim=-1) >= tol
+        c = torch.where(moving[:, None, None], c_, c)
+        moving = moving & moved & ~repeat
+        remaining = int(moving.sum())
+        if not remaining:
+            break
+        if 2 * remaining <= n:
+            centroids[idx] = c
+            keep = moving.nonzero().squeeze(-1)
+            idx, xt, x1, c, assign, moving = idx[keep], xt[keep], x1[keep], c[keep], assign[keep], moving[keep]
+    centroids[idx] = c
+    return centroids
+def batch_FPC(y, n_samples):
+    # y: N x S x L x 2, S predictions of each of the N agents
+    # returns N x n_samples indices of the predictions closest to the goal clusters
+    goal = y[..., -1, :2]
+    goal_ = batch_kmeans(n_samples, goal)
+    dist = (goal_.unsqueeze(2) - goal.unsqueeze(1)).norm(dim=-1)  # N x n_samples x S
+    return dist.argmin(-1)
+def select_FPC(pool, n_samples, fpc):
+    # pool: S x L x N x 2 predictions; the first n_samples * fpc are clustered
+    # returns n_samples x L x N x 2 predictions closest to the goal clusters,
+    # the first n_samples without FPC, or pool itself for the mean prediction
+    if n_samples > 0 and fpc > 1:
+        y_ = pool[:n_samples * fpc]
+        cand = batch_FPC(y_.permute(2, 0, 1, 3), n_samples=n_samples)  # N x K
+        cand = cand.t()[:, None, :, None].expand(-1, y_.size(1), -1, y_.size(-1))
+        return y_.gather(0, cand)
+    if n_samples > 0:
+        return pool[:n_samples]
+    return pool
+def FPC_ADE_FDE(pool, y, n_samples, fpc):
+    # per-agent ADE and FDE of the predictions chosen by select_FPC, the best of the n_samples
+    ade, fde = ADE_FDE(select_FPC(pool, n_samples, fpc), y)
+    if n_samples > 0:
+        ade = torch.min(ade, dim=0)[0]
+        fde = torch.min(fde, dim=0)[0]
+    return ade, fde
 def seed(seed: int):
     rand = seed is None
     if seed is None: